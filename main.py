@@ -1,9 +1,13 @@
 from fastapi import FastAPI
 from sqlmodel import SQLModel
-from routes.db import engine
+from routes.db import engine, ensure_extensions, ensure_columns, ensure_indexes
 from routes import all_routers
+from routes.emailoutbox import outbox_worker
+from routes.invoice import backfill_invoice_search, backfill_invoice_tax_summary
+from routes.ledger import backfill_customer_ledger
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime
+import os
 from fastapi.openapi.utils import get_openapi
 
 app = FastAPI(
@@ -29,7 +33,24 @@ app.add_middleware(
 )
 @app.on_event("startup")
 def on_startup():
+    ensure_extensions()
     SQLModel.metadata.create_all(engine)
+    ensure_columns()
+    ensure_indexes()
+    # derived tables introduced after invoices already existed
+    backfill_invoice_search()
+    backfill_invoice_tax_summary()
+    backfill_customer_ledger()
+
+@app.on_event("startup")
+async def start_email_outbox():
+    # In-process outbox worker; leave off when routes/run_email.py runs it standalone
+    if os.getenv("PROBILL_EMAIL_WORKER", "0") == "1":
+        outbox_worker.start()
+
+@app.on_event("shutdown")
+async def stop_email_outbox():
+    await outbox_worker.stop()
 
 # Include all routers dynamically
 for router in all_routers:
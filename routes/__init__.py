@@ -20,9 +20,21 @@ from .receipts import router as receipts_router
 from .license import router as licenses_router
 from .emailconfig import router as emailconfig_router
 from .upload import router as upload_router
+from .docseries import router as docseries_router
+from .invoicepdf import router as invoicepdf_router
+from .invoicebulk import router as invoicebulk_router
+from .idempotency import router as idempotency_router
+from .receiptalloc import router as receiptalloc_router
+from .bankrecon import router as bankrecon_router
+from .ledger import router as ledger_router
+from .aging import router as aging_router
+from .emailoutbox import router as emailoutbox_router
 
 all_routers = [users_router, usersrole_router, 
                company_router,currency_router,finyr_router,uom_router,taxmaster_router,
                product_router,customer_router,country_router,state_router,city_router,
                dbexcel_router,importdb_router,login_router,hsn_router,
-               customer_router,invoice_router,receipts_router,licenses_router,emailconfig_router,upload_router]
+               customer_router,invoice_router,receipts_router,licenses_router,emailconfig_router,upload_router,
+               docseries_router,invoicepdf_router,invoicebulk_router,
+               idempotency_router,receiptalloc_router,bankrecon_router,ledger_router,
+               aging_router,emailoutbox_router]
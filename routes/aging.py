@@ -0,0 +1,124 @@
+from fastapi import APIRouter, Depends
+from sqlmodel import Session
+from sqlalchemy import text
+from pydantic import BaseModel
+from .db import get_session
+from typing import List, Optional, Tuple
+from datetime import datetime, date
+from collections import OrderedDict
+from threading import Lock
+import os
+from routes.ledger import ledger_version
+
+
+router = APIRouter(tags=["Customer"])
+
+# Receivables aging
+#
+# One aggregate over the company's open invoices (partial, covering index
+# ix_invoice_header_aging) buckets the outstanding amount by age; ROLLUP adds the
+# company total in the same pass. Results are cached per company and as-of date
+# (least recently used entries evicted). Every write to a company's invoices,
+# receipt amounts or customer names bumps its ledger_version in the same
+# transaction (see routes/ledger.py), so a changed version invalidates the entry.
+
+AGING_SQL = text("""
+    SELECT o.customerid,
+           CASE WHEN GROUPING(o.customerid) = 0 THEN MAX(c.customername) END AS customername,
+           COALESCE(SUM(o.balance) FILTER (WHERE o.age <= 30), 0) AS bucket_0_30,
+           COALESCE(SUM(o.balance) FILTER (WHERE o.age BETWEEN 31 AND 60), 0) AS bucket_31_60,
+           COALESCE(SUM(o.balance) FILTER (WHERE o.age BETWEEN 61 AND 90), 0) AS bucket_61_90,
+           COALESCE(SUM(o.balance) FILTER (WHERE o.age > 90), 0) AS bucket_90_plus,
+           SUM(o.balance) AS total,
+           COUNT(*) AS invoices
+    FROM (
+        SELECT customerid, totnetamount - COALESCE(receiptamount, 0) AS balance,
+               CAST(:asof AS date) - invoicedate AS age
+        FROM invoice_header
+        WHERE companyid = :companyid
+          AND cancel = 'F'
+          AND totnetamount > COALESCE(receiptamount, 0)
+          AND invoicedate <= :asof
+    ) o
+    LEFT JOIN customer c ON c.id = o.customerid
+    GROUP BY ROLLUP (o.customerid)
+    ORDER BY o.customerid NULLS LAST
+""")
+
+
+class AgingRow(BaseModel):
+    customerid: Optional[int] = None  # None on the company total
+    customername: Optional[str] = None
+    bucket_0_30: float
+    bucket_31_60: float
+    bucket_61_90: float
+    bucket_90_plus: float
+    total: float
+    invoices: int
+
+
+class AgingReport(BaseModel):
+    companyid: int
+    asof: date
+    generatedon: datetime
+    customers: List[AgingRow] = []
+    company: Optional[AgingRow] = None
+
+
+AGING_CACHE_SIZE = int(os.getenv("PROBILL_AGING_CACHE_SIZE", "256"))
+
+# (companyid, asof) -> (ledger_version, report), oldest use first
+_aging_cache: "OrderedDict[Tuple[int, date], Tuple[int, AgingReport]]" = OrderedDict()
+_aging_lock = Lock()
+
+
+def build_aging_report(session: Session, companyid: int, asof: date) -> AgingReport:
+    rows = session.execute(AGING_SQL, {"companyid": companyid, "asof": asof}).mappings().all()
+    customers, company = [], None
+    for r in rows:
+        row = AgingRow(**{k: (round(v, 2) if isinstance(v, float) else v) for k, v in r.items()})
+        if r["customerid"] is None:
+            company = row
+        else:
+            customers.append(row)
+    return AgingReport(
+        companyid=companyid, asof=asof, generatedon=datetime.now(), customers=customers, company=company
+    )
+
+
+@router.get("/customer/aging/{companyid}", response_model=AgingReport)
+def receivables_aging(
+    companyid: int,
+    asof: Optional[date] = None,
+    customerid: Optional[int] = None,
+    refresh: bool = False,
+    session: Session = Depends(get_session),
+):
+    asof = asof or date.today()
+
+    # ✅ Step 1: cache is valid while no invoice/receipt of the company was written
+    stamp = ledger_version(session, companyid)
+    key = (companyid, asof)
+    with _aging_lock:
+        cached = _aging_cache.get(key)
+        if cached:
+            _aging_cache.move_to_end(key)
+    if cached and cached[0] == stamp and not refresh:
+        report = cached[1]
+    else:
+        # ✅ Step 2: one aggregate query, then cache it
+        report = build_aging_report(session, companyid, asof)
+        with _aging_lock:
+            # entries of this company built before its last write are stale
+            for k in [k for k, v in _aging_cache.items() if k[0] == companyid and v[0] != stamp]:
+                del _aging_cache[k]
+            _aging_cache[key] = (stamp, report)
+            _aging_cache.move_to_end(key)
+            while len(_aging_cache) > AGING_CACHE_SIZE:
+                _aging_cache.popitem(last=False)
+
+    if customerid:
+        return report.model_copy(update={
+            "customers": [c for c in report.customers if c.customerid == customerid]
+        })
+    return report
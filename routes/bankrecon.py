@@ -0,0 +1,335 @@
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
+from sqlmodel import Session, select, func
+from sqlalchemy import insert
+from pydantic import BaseModel
+from .db import get_session
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, date, timedelta
+from collections import defaultdict
+from routes.company import Company
+from routes.invoice import InvoiceHeader
+from routes.receipts import ReceiptsHeader, ReceiptsDetail, refresh_invoice_receipt_amounts
+from routes.docseries import allocate_document_nos, get_financial_year
+from routes.ledger import sync_customer_ledger
+import csv
+import io
+import re
+
+
+router = APIRouter(tags=["Receipts"])
+
+# Bank statement reconciliation.
+#
+# The uploaded CSV stays in the upload's spooled temp file and is read row by
+# row twice: once for the date range, once to match. Receipts of that range are
+# fetched with one query into hash indexes (transaction no, cheque no, amount);
+# each credit line is then matched with dictionary lookups only. With
+# createreceipts, lines that match no receipt are tried against open invoices
+# (invoice no in the narration for up to its balance, else a unique outstanding
+# amount) and receipts are created for them in bulk.
+
+# Accepted header names (lower case, letters/digits only) for each field
+CSV_COLUMNS = {
+    "date": ("date", "txndate", "transactiondate", "valuedate", "postingdate"),
+    "amount": ("amount", "credit", "creditamount", "deposit", "deposits", "cr"),
+    "reference": ("reference", "referenceno", "refno", "transactionno", "utr", "utrno", "transactionid"),
+    "cheque": ("chequeno", "chqno", "cheque", "checkno", "chqrefno"),
+    "description": ("description", "narration", "particulars", "remarks", "details"),
+}
+DATE_FORMATS = ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%d-%b-%Y", "%d %b %Y")
+
+
+class BankLine(BaseModel):
+    line: int
+    date: date
+    amount: float
+    reference: Optional[str] = None
+    cheque: Optional[str] = None
+    description: Optional[str] = None
+
+
+class BankMatch(BankLine):
+    receiptid: Optional[int] = None
+    receiptno: Optional[str] = None
+    invoiceid: Optional[int] = None
+    invoiceno: Optional[str] = None
+    matchedon: str
+
+
+class BankAmbiguous(BankLine):
+    receiptids: List[int] = []
+
+
+class BankReconResponse(BaseModel):
+    lines: int
+    skipped: int
+    matched: List[BankMatch] = []
+    ambiguous: List[BankAmbiguous] = []
+    unmatched: List[BankLine] = []
+    created: List[BankMatch] = []
+
+
+def _key(value: Optional[str]) -> str:
+    return re.sub(r"[^0-9A-Z]", "", (value or "").upper())
+
+
+def _paise(amount: float) -> int:
+    return int(round(amount * 100))
+
+
+def _parse_date(value: str) -> Optional[date]:
+    value = (value or "").strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_amount(value: str) -> float:
+    value = (value or "").replace(",", "").strip()
+    return float(value) if value else 0.0
+
+
+def _column_map(header: List[str]) -> Dict[str, int]:
+    names = [re.sub(r"[^0-9a-z]", "", h.lower()) for h in header]
+    mapping = {}
+    for field, aliases in CSV_COLUMNS.items():
+        for i, name in enumerate(names):
+            if name in aliases:
+                mapping[field] = i
+                break
+    if "date" not in mapping or "amount" not in mapping:
+        raise HTTPException(status_code=400, detail="CSV needs a date and an amount/credit column")
+    return mapping
+
+
+def _bank_lines(upload: UploadFile):
+    """Yield the credit lines of the statement, reading the file row by row."""
+    upload.file.seek(0)
+    text = io.TextIOWrapper(upload.file, encoding="utf-8-sig", errors="replace", newline="")
+    try:
+        reader = csv.reader(text)
+        header = next(reader, None)
+        if not header:
+            raise HTTPException(status_code=400, detail="Empty statement")
+        cols = _column_map(header)
+
+        def cell(row, field):
+            i = cols.get(field)
+            return row[i].strip() if i is not None and i < len(row) else None
+
+        for lineno, row in enumerate(reader, start=2):
+            if not any(row):
+                continue
+            try:
+                txndate = _parse_date(cell(row, "date"))
+                amount = _parse_amount(cell(row, "amount"))
+            except ValueError:
+                txndate, amount = None, 0.0
+            if txndate is None or amount <= 0:
+                yield lineno, None  # debit, opening balance or unreadable row
+                continue
+            yield lineno, BankLine(
+                line=lineno, date=txndate, amount=amount,
+                reference=cell(row, "reference") or None,
+                cheque=cell(row, "cheque") or None,
+                description=cell(row, "description") or None,
+            )
+    finally:
+        text.detach()  # leave the upload's file open for the second pass
+
+
+class _ReceiptIndex:
+    def __init__(self, rows):
+        self.by_txn: Dict[str, List] = defaultdict(list)
+        self.by_cheque: Dict[str, List] = defaultdict(list)
+        self.by_amount: Dict[int, List] = defaultdict(list)
+        for r in rows:
+            if _key(r.transactionno):
+                self.by_txn[_key(r.transactionno)].append(r)
+            if _key(r.chequeno):
+                self.by_cheque[_key(r.chequeno)].append(r)
+            self.by_amount[_paise(r.receiptamount)].append(r)
+        self.used = set()
+
+    def match(self, line: BankLine, window: timedelta) -> Tuple[str, List]:
+        """(how, candidates); a single candidate is a match."""
+        paise = _paise(line.amount)
+        for how, index, key in (
+            ("transactionno", self.by_txn, _key(line.reference)),
+            ("chequeno", self.by_cheque, _key(line.cheque)),
+        ):
+            if not key:
+                continue
+            found = [r for r in index.get(key, ()) if r.id not in self.used]
+            if len(found) > 1:
+                found = [r for r in found if _paise(r.receiptamount) == paise] or found
+            if found:
+                return how, found
+        found = [
+            r for r in self.by_amount.get(paise, ())
+            if r.id not in self.used and abs(r.receiptdate - line.date) <= window
+        ]
+        if len(found) > 1:
+            # closest date wins when it is unique
+            best = min(abs(r.receiptdate - line.date) for r in found)
+            closest = [r for r in found if abs(r.receiptdate - line.date) == best]
+            found = closest if len(closest) == 1 else found
+        return "amount", found
+
+
+class _InvoiceIndex:
+    def __init__(self, rows):
+        self.by_no = {_key(r.invoiceno): r for r in rows}
+        self.by_balance: Dict[int, List] = defaultdict(list)
+        for r in rows:
+            self.by_balance[_paise(r.totnetamount - (r.receiptamount or 0))].append(r)
+        self.used = set()
+
+    def match(self, line: BankLine):
+        paise = _paise(line.amount)
+        for token in re.split(r"[\s,;]+", f"{line.reference or ''} {line.description or ''}"):
+            inv = self.by_no.get(_key(token))
+            # a credit above the outstanding balance would overpay the invoice: leave it unmatched
+            if inv is not None and inv.id not in self.used \
+                    and paise <= _paise(inv.totnetamount - (inv.receiptamount or 0)):
+                return "invoiceno", inv
+        found = [r for r in self.by_balance.get(paise, ()) if r.id not in self.used]
+        return ("balance", found[0]) if len(found) == 1 else (None, None)
+
+
+def _create_receipts(session: Session, companyid: int, createdby: str, pending: List[Tuple[BankLine, object]]):
+    """One receipt per (bank line, invoice) with multi-row INSERTs; returns receipt numbers."""
+    company = session.get(Company, companyid)
+    now = datetime.now()
+    numbers: Dict[int, str] = {}
+    by_year = defaultdict(list)
+    for i, (line, _) in enumerate(pending):
+        by_year[get_financial_year(line.date)].append(i)
+    for positions in by_year.values():
+        issued = allocate_document_nos(session, companyid, "REC", pending[positions[0]][0].date, len(positions))
+        for pos, no in zip(positions, issued):
+            numbers[pos] = no
+
+    headers = [
+        {
+            "cancel": "F", "sourceid": 0, "createdby": createdby, "createdon": now,
+            "modifiedby": createdby, "modifiedon": now, "app_desc": 1, "app_level": 0,
+            "companyid": companyid, "companyno": company.companyno,
+            "receiptno": numbers[i], "receiptdate": line.date, "receipttype": "Bank",
+            "customerid": inv.customerid, "receiptamount": line.amount, "paymentmode": "Bank",
+            "currencyid": inv.currencyid, "exrate": inv.exrate,
+            "transactionno": line.reference, "transactiondate": line.date,
+            "chequeno": line.cheque, "cheqedate": line.date if line.cheque else None,
+            "remarks": f"Bank reconciliation: {line.description or ''}".strip()[:250],
+            "totalreceiptamount": line.amount,
+        }
+        for i, (line, inv) in enumerate(pending)
+    ]
+    ids = session.execute(
+        insert(ReceiptsHeader).returning(ReceiptsHeader.id, sort_by_parameter_order=True), headers
+    ).scalars().all()
+    session.execute(insert(ReceiptsDetail), [
+        {
+            "receiptheaderid": rid, "rowno": 1, "invoiceno": inv.id, "invoicedate": inv.invoicedate,
+            "invoiceamount": inv.totnetamount, "gcurrency": inv.currencyid, "gexrate": inv.exrate,
+            "greceiptamount": line.amount, "commisionamount": 0.0, "tdsamount": 0.0,
+            "netreceiptamount": line.amount,
+        }
+        for rid, (line, inv) in zip(ids, pending)
+    ])
+    refresh_invoice_receipt_amounts(session, list({inv.id for _, inv in pending}))
+    sync_customer_ledger(session, "REC", list(ids))
+    return list(zip(ids, (numbers[i] for i in range(len(pending)))))
+
+
+@router.post("/receipts/reconcile/{companyid}", response_model=BankReconResponse)
+def reconcile_bank_statement(
+    companyid: int,
+    file: UploadFile = File(...),
+    datewindow: int = Form(3),
+    createreceipts: bool = Form(False),
+    createdby: Optional[str] = Form(None),
+    session: Session = Depends(get_session),
+):
+    if createreceipts and not createdby:
+        raise HTTPException(status_code=400, detail="createdby is required to create receipts")
+    window = timedelta(days=max(datewindow, 0))
+
+    # ✅ Step 1: first pass, statement date range only
+    first = last = None
+    for _, line in _bank_lines(file):
+        if line is not None:
+            first = line.date if first is None or line.date < first else first
+            last = line.date if last is None or line.date > last else last
+    if first is None:
+        return BankReconResponse(lines=0, skipped=0)
+
+    # ✅ Step 2: one bulk query for the candidate receipts → hash indexes
+    rh = ReceiptsHeader
+    receipts = _ReceiptIndex(session.exec(
+        select(rh.id, rh.receiptno, rh.receiptdate, rh.receiptamount, rh.transactionno, rh.chequeno)
+        .where(
+            rh.companyid == companyid,
+            rh.cancel != "T",
+            rh.receiptdate >= first - window,
+            rh.receiptdate <= last + window,
+        )
+    ).all())
+
+    # ✅ Step 3: second pass, match line by line
+    result = BankReconResponse(lines=0, skipped=0)
+    for lineno, line in _bank_lines(file):
+        result.lines += 1
+        if line is None:
+            result.skipped += 1
+            continue
+        how, found = receipts.match(line, window)
+        if len(found) == 1:
+            receipts.used.add(found[0].id)
+            result.matched.append(BankMatch(
+                **line.model_dump(), receiptid=found[0].id, receiptno=found[0].receiptno, matchedon=how
+            ))
+        elif found:
+            result.ambiguous.append(BankAmbiguous(**line.model_dump(), receiptids=[r.id for r in found]))
+        else:
+            result.unmatched.append(line)
+
+    # ✅ Step 4 (optional): receipts for unmatched credits that settle an open invoice
+    if createreceipts and result.unmatched:
+        inv = InvoiceHeader
+        invoices = _InvoiceIndex(session.exec(
+            select(inv.id, inv.invoiceno, inv.invoicedate, inv.customerid, inv.currencyid, inv.exrate,
+                   inv.totnetamount, inv.receiptamount)
+            .where(
+                inv.companyid == companyid,
+                inv.cancel == "F",
+                inv.totnetamount > func.coalesce(inv.receiptamount, 0),
+            )
+        ).all())
+        pending, still_unmatched, hows = [], [], []
+        for line in result.unmatched:
+            how, target = invoices.match(line)
+            if target is None:
+                still_unmatched.append(line)
+                continue
+            invoices.used.add(target.id)
+            pending.append((line, target))
+            hows.append(how)
+        if pending:
+            try:
+                created = _create_receipts(session, companyid, createdby, pending)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                raise HTTPException(status_code=500, detail=f"Error creating receipts: {e}")
+            result.created = [
+                BankMatch(**line.model_dump(), receiptid=rid, receiptno=no,
+                          invoiceid=target.id, invoiceno=target.invoiceno, matchedon=how)
+                for (rid, no), (line, target), how in zip(created, pending, hows)
+            ]
+            result.unmatched = still_unmatched
+
+    return result
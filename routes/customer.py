@@ -399,9 +399,17 @@ def update_customer(customerid: int , upd:UpdateCustomer, session: Session = Dep
     if not db_customer:
         raise HTTPException(status_code=404, detail="Customer not found")
 
+    renamed = upd.customername != db_customer.customername
     for key, value in upd.model_dump(exclude={"contacts"}).items():
         setattr(db_customer, key, value)
     session.add(db_customer)
+    if renamed:
+        # invoice search rows and the aging report carry the customer name; same transaction
+        from routes.invoice import reindex_invoices_by_name
+        from routes.ledger import bump_ledger_version
+        session.flush()
+        reindex_invoices_by_name(session, customerid=customerid)
+        bump_ledger_version(session, [db_customer.companyid])
     session.commit()
     session.refresh(db_customer)
     if upd.contacts:
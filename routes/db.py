@@ -7,4 +7,48 @@ engine = create_engine(DATABASE_URL,echo=False)
 def get_session():
     with Session(engine) as session:
        yield session
+
+def ensure_extensions():
+    # pg_trgm backs the trigram (GIN) search indexes; must exist before create_all()
+    from sqlalchemy import text
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+def ensure_columns():
+    # create_all() never alters existing tables; add columns declared on a model
+    # later. Only columns that are nullable or carry a server_default can be
+    # added to a populated table.
+    from sqlalchemy import inspect, text
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            present = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    continue
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN IF NOT EXISTS "{column.name}" ' \
+                      f"{column.type.compile(dialect=engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                conn.execute(text(ddl))
+
+def ensure_indexes():
+    # create_all() skips tables that already exist, so indexes added to a model
+    # later are created here (views mapped as models are skipped)
+    from sqlalchemy import inspect
+    views = set(inspect(engine).get_view_names())
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            if table.name in views:
+                continue
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
 Base = declarative_base()
\ No newline at end of file
@@ -0,0 +1,163 @@
+from fastapi import APIRouter, Depends
+from sqlmodel import Session, select, SQLModel, Field
+from sqlalchemy import UniqueConstraint, update, text
+from sqlalchemy.dialects.postgresql import insert
+from .db import engine, get_session
+from typing import Dict, List, Tuple
+from datetime import datetime, date
+import os
+import threading
+
+
+router = APIRouter(tags=["DocSeries"])
+
+# Document types with their prefix and the (table, column) holding the issued numbers.
+# The column is only read once per company/type/year to seed a brand-new counter row.
+DOCUMENT_TYPES = {
+    "INV": ("invoice_header", "invoiceno"),
+    "REC": ("receipts_header", "receiptno"),
+}
+
+# Numbers reserved per worker process at a time. 0/1 = allocate inside the caller's
+# transaction (gapless, counter row stays locked until the document commits).
+# >1 = reserve a block in a short transaction of its own and hand numbers out from
+# memory (no lock held across the document insert, but numbers of a crashed or
+# idle worker are skipped).
+DOCNO_BLOCK_SIZE = int(os.getenv("PROBILL_DOCNO_BLOCK_SIZE", "0"))
+
+
+class DocumentSequence(SQLModel, table=True):
+    __tablename__ = "document_sequence"
+    __table_args__ = (
+        UniqueConstraint("companyid", "doctype", "finyr", name="uq_document_sequence"),
+        {"extend_existing": True},
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    companyid: int = Field(foreign_key="company.id", nullable=False)
+    doctype: str = Field(nullable=False)
+    finyr: str = Field(nullable=False)
+    lastno: int = Field(default=0, nullable=False)
+    modifiedon: datetime = Field(default_factory=datetime.now)
+
+
+def get_financial_year(docdate: date) -> str:
+    year = docdate.year
+    if docdate.month < 4:  # Jan–Mar → previous FY
+        start_year = year - 1
+        end_year = year
+    else:
+        start_year = year
+        end_year = year + 1
+    return f"{start_year}-{str(end_year)[2:]}"  # e.g. 2025-26
+
+
+def format_document_no(doctype: str, finyr: str, number: int) -> str:
+    return f"{doctype}/{finyr}-{number:04d}"
+
+
+def _seed_lastno(session: Session, companyid: int, doctype: str, finyr: str) -> int:
+    # Continue from numbers issued before the counter existed
+    table, column = DOCUMENT_TYPES[doctype]
+    return session.execute(
+        text(
+            f"SELECT COALESCE(MAX(CAST(substring({column} from '-([0-9]+)$') AS integer)), 0) "
+            f"FROM {table} WHERE companyid = :companyid AND {column} LIKE :pattern"
+        ),
+        {"companyid": companyid, "pattern": f"{doctype}/{finyr}-%"},
+    ).scalar_one()
+
+
+def _reserve(session: Session, companyid: int, doctype: str, finyr: str, count: int) -> int:
+    """Advance the counter by `count` and return the last number reserved.
+
+    The UPDATE takes a row lock on the counter that is held until the caller's
+    transaction ends, so concurrent callers are serialised on one indexed row.
+    """
+    seq = DocumentSequence.__table__
+    now = datetime.now()
+
+    lastno = session.execute(
+        update(seq)
+        .where(
+            seq.c.companyid == companyid,
+            seq.c.doctype == doctype,
+            seq.c.finyr == finyr,
+        )
+        .values(lastno=seq.c.lastno + count, modifiedon=now)
+        .returning(seq.c.lastno)
+    ).scalar()
+    if lastno is not None:
+        return lastno
+
+    # First document of this type/year → create the counter (race-safe)
+    seed = _seed_lastno(session, companyid, doctype, finyr)
+    stmt = insert(seq).values(
+        companyid=companyid, doctype=doctype, finyr=finyr, lastno=seed + count, modifiedon=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[seq.c.companyid, seq.c.doctype, seq.c.finyr],
+        set_={"lastno": seq.c.lastno + count, "modifiedon": now},
+    ).returning(seq.c.lastno)
+    return session.execute(stmt).scalar_one()
+
+
+def allocate_document_nos(
+    session: Session, companyid: int, doctype: str, docdate: date, count: int = 1
+) -> List[str]:
+    """Reserve `count` consecutive numbers in the caller's transaction."""
+    if doctype not in DOCUMENT_TYPES:
+        raise ValueError(f"Unknown document type {doctype}")
+    if count < 1:
+        return []
+    finyr = get_financial_year(docdate)
+    lastno = _reserve(session, companyid, doctype, finyr, count)
+    return [format_document_no(doctype, finyr, n) for n in range(lastno - count + 1, lastno + 1)]
+
+
+# (companyid, doctype, finyr) -> [next number, last number of the reserved block]
+_blocks: Dict[Tuple[int, str, str], List[int]] = {}
+# One lock per series, so a block reservation only holds up its own series
+_block_locks: Dict[Tuple[int, str, str], threading.Lock] = {}
+_block_locks_lock = threading.Lock()
+
+
+def _block_lock(key: Tuple[int, str, str]) -> threading.Lock:
+    with _block_locks_lock:
+        lock = _block_locks.get(key)
+        if lock is None:
+            lock = _block_locks[key] = threading.Lock()
+        return lock
+
+
+def _next_from_block(companyid: int, doctype: str, finyr: str) -> int:
+    key = (companyid, doctype, finyr)
+    with _block_lock(key):
+        block = _blocks.get(key)
+        if not block or block[0] > block[1]:
+            with Session(engine) as block_session:
+                lastno = _reserve(block_session, companyid, doctype, finyr, DOCNO_BLOCK_SIZE)
+                block_session.commit()
+            block = [lastno - DOCNO_BLOCK_SIZE + 1, lastno]
+            _blocks[key] = block
+        number = block[0]
+        block[0] += 1
+        return number
+
+
+def next_document_no(session: Session, companyid: int, doctype: str, docdate: date) -> str:
+    """Next document number for a company, e.g. INV/2025-26-0042."""
+    if DOCNO_BLOCK_SIZE > 1:
+        if doctype not in DOCUMENT_TYPES:
+            raise ValueError(f"Unknown document type {doctype}")
+        finyr = get_financial_year(docdate)
+        return format_document_no(doctype, finyr, _next_from_block(companyid, doctype, finyr))
+    return allocate_document_nos(session, companyid, doctype, docdate, 1)[0]
+
+
+@router.get("/docseries/{companyid}", response_model=List[DocumentSequence])
+def get_document_series(companyid: int, session: Session = Depends(get_session)):
+    return session.exec(
+        select(DocumentSequence)
+        .where(DocumentSequence.companyid == companyid)
+        .order_by(DocumentSequence.finyr.desc(), DocumentSequence.doctype)
+    ).all()
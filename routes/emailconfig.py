@@ -1,14 +1,16 @@
 from fastapi import APIRouter, HTTPException, Depends, Query 
 from sqlmodel import Session, select, SQLModel, Field, func, and_
 from .db import engine, get_session
+from sqlalchemy import Index, text
 from sqlalchemy.dialects.postgresql import ARRAY, INTEGER, JSON
 from pydantic import EmailStr, validator, BaseModel
-from typing import List, Optional 
+from typing import Dict, List, Optional 
 from datetime import datetime, date    
 from routes.utils import encrypt_password, decrypt_password
 import smtplib 
 from email.message import EmailMessage
 from routes.company import Company
+from routes.smtppool import SmtpSettings
 
 
 router = APIRouter(tags=["Email"])
@@ -29,7 +31,12 @@ class EmailConfig(SQLModel, table=True):
 
 class EmailSetting(SQLModel, table=True):
     __tablename__ = "email_settings"
-    __table_args__ = {"extend_existing": True}  
+    __table_args__ = (
+        # outbox polling: unsent, not dead-lettered mail in due order
+        Index("ix_email_settings_due", "id",
+              postgresql_where=text("sent_status = false AND deadletter = false")),
+        {"extend_existing": True},
+    )
     id: int | None = Field(default=None, primary_key=True) 
     companyid: Optional[int] = None
     companyno: Optional[str] = None
@@ -45,6 +52,11 @@ class EmailSetting(SQLModel, table=True):
     createdon: datetime = Field(default_factory=datetime.now) 
     error: Optional[str] = None
     createdby: Optional[str] = None
+    attempts: int = Field(default=0, nullable=False, sa_column_kwargs={"server_default": "0"})
+    next_attempt_at: Optional[datetime] = None  # retry backoff; None = due now
+    deadletter: bool = Field(default=False, nullable=False, sa_column_kwargs={"server_default": "false"})
+    claimed_at: Optional[datetime] = None  # lease held by an outbox worker
+    claimed_by: Optional[str] = None
 
 class PostemailConfig(BaseModel):
     id: Optional[int] = None
@@ -148,7 +160,6 @@ def test_smtp_connection(es: TestEmailConfig):
         "password": es.email_password.strip(),
         "use_tls": es.use_tls
     }
-    print("SMTP CONFIG VALUES:", config) 
     
     try:
         with smtplib.SMTP(config["host"], config["port"], timeout=10) as smtp:
@@ -201,83 +212,36 @@ def send_test_email(es: TestEmailConfig):
 
 
 
-@router.post("/sendpending")
-def send_pending_emails():
-    with Session(engine) as session:
-        config = session.query(EmailConfig).order_by(EmailConfig.id.desc()).first()
-        if not config:
-            raise HTTPException(status_code=400, detail="Email config not found")
-
-        # Use email_username if available, otherwise use email_from
-        smtp_username =  config.email_from
-        smtp_password = config.email_password
-        
-        pending = session.query(EmailSetting).filter_by(sent_status=False).all()
-
-        sent_count = 0
-        failed_emails = []
-
-        for email in pending:
-            try:
-                print("------------------------------------------------")
-                print("SMTP USER:", smtp_username)
-                print("SMTP HOST:", config.smtp_host)
-                print("SMTP PORT:", config.smtp_port)
-                print("Sending To:", email.email_to)
-                print("Subject:", email.subject)
-                print("------------------------------------------------")
-
-                msg = EmailMessage()
-                msg["From"] = config.email_from  # Display name
-                msg["To"] = email.email_to
-                msg["Subject"] = email.subject
-                
-                # Add CC if present
-                if email.email_cc:
-                    msg["Cc"] = email.email_cc
-                
-                # Add BCC if present
-                if email.email_bcc:
-                    msg["Bcc"] = email.email_bcc
-                
-                msg.set_content(email.body)
-
-                with smtplib.SMTP(config.smtp_host, int(config.smtp_port), timeout=10) as smtp:
-                    smtp.ehlo()
-                    if config.use_tls:
-                        smtp.starttls()
-                        smtp.ehlo()
-
-                    smtp.login(smtp_username, smtp_password)
-                    smtp.send_message(msg)
-
-                email.sent_status = True
-                email.sent_at = datetime.utcnow()
-                email.error = None
-                session.commit()
-                sent_count += 1
-                print(f"✅ Successfully sent to {email.email_to}")
-
-            except Exception as e:
-                error_msg = str(e)
-                print(f"❌ Failed to send to {email.email_to}: {error_msg}")
-                
-                # Store error in database
-                email.error = error_msg
-                session.commit()
-                
-                failed_emails.append({
-                    "email_to": email.email_to,
-                    "error": error_msg
-                })
+def smtp_settings(config: EmailConfig) -> SmtpSettings:
+    return SmtpSettings(
+        host=config.smtp_host.strip(),
+        port=int(config.smtp_port),
+        use_tls=config.use_tls,
+        username=config.email_from,
+        password=config.email_password,
+    )
+
+def build_email_message(config: EmailConfig, email: EmailSetting) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = config.email_from
+    msg["To"] = email.email_to
+    msg["Subject"] = email.subject
+    if email.email_cc:
+        msg["Cc"] = email.email_cc
+    if email.email_bcc:
+        msg["Bcc"] = email.email_bcc
+    msg.set_content(email.body)
+    return msg
+
+def email_configs_by_company(session: Session) -> Dict[Optional[int], EmailConfig]:
+    # Latest config per company; key None is the latest overall (used when a
+    # company has no config of its own)
+    configs: Dict[Optional[int], EmailConfig] = {}
+    for config in session.exec(select(EmailConfig).order_by(EmailConfig.id.desc())).all():
+        configs.setdefault(None, config)
+        configs.setdefault(config.companyid, config)
+    return configs
 
-        return {
-            "status": "success" if sent_count > 0 else "failed",
-            "emails_sent": sent_count,
-            "total_pending": len(pending),
-            "failed": failed_emails
-        }
-    
 @router.get("/getemailconfig/{companyid}", response_model=PostemailConfig | None)
 def get_emailconfig(companyid: int, session: Session = Depends(get_session)):
 
@@ -0,0 +1,273 @@
+from fastapi import APIRouter, HTTPException
+from sqlmodel import Session, select
+from sqlalchemy import update, text, bindparam
+from .db import engine
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from routes.emailconfig import EmailSetting, email_configs_by_company, build_email_message, smtp_settings
+from routes.smtppool import SMTP_POOL_SIZE, SmtpSettings, get_smtp_pool
+
+
+router = APIRouter(tags=["Email"])
+logger = logging.getLogger(__name__)
+
+# Email outbox worker
+#
+# email_settings is the outbox. An asyncio worker polls it for due mail, sends
+# with bounded concurrency over the pooled SMTP sessions (blocking smtplib and DB
+# calls run in threads, never in an API request), and records each outcome: sent,
+# or attempts + 1 with an exponential backoff before the next try. After
+# EMAIL_MAX_ATTEMPTS the mail is dead-lettered and left for a manual requeue.
+#
+# Any number of workers (processes or nodes) can drain the outbox together: a
+# worker claims a batch with FOR UPDATE SKIP LOCKED, stamping claimed_at /
+# claimed_by, and commits. Other workers skip locked and leased rows, so no mail
+# is sent twice; a lease left by a crashed worker expires after EMAIL_LEASE.
+# Outcomes are only written while the worker still holds the lease.
+#
+# Runs in-process (PROBILL_EMAIL_WORKER=1, or on demand via /sendpending) or
+# standalone: python routes/run_email.py [--forever]
+
+EMAIL_CONCURRENCY = int(os.getenv("PROBILL_EMAIL_CONCURRENCY", str(SMTP_POOL_SIZE)))
+EMAIL_BATCH = int(os.getenv("PROBILL_EMAIL_BATCH", "200"))
+EMAIL_POLL_SECONDS = float(os.getenv("PROBILL_EMAIL_POLL_SECONDS", "10"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("PROBILL_EMAIL_MAX_ATTEMPTS", "6"))
+EMAIL_BACKOFF = timedelta(minutes=1)   # 1, 2, 4, 8, 16 minutes ...
+EMAIL_BACKOFF_MAX = timedelta(hours=6)
+# Longer than a batch takes to send, or a slow worker's mail could be claimed again
+EMAIL_LEASE = timedelta(seconds=int(os.getenv("PROBILL_EMAIL_LEASE_SECONDS", "600")))
+
+CLAIM_EMAILS_SQL = text("""
+    UPDATE email_settings e
+    SET claimed_at = :now, claimed_by = :worker
+    FROM (
+        SELECT id FROM email_settings
+        WHERE sent_status = false AND deadletter = false
+          AND (next_attempt_at IS NULL OR next_attempt_at <= :now)
+          AND (claimed_at IS NULL OR claimed_at < :expired)
+        ORDER BY id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    ) due
+    WHERE e.id = due.id
+    RETURNING e.id
+""")
+
+
+class OutboxJob(NamedTuple):
+    id: int
+    attempts: int
+    settings: Optional[SmtpSettings]
+    message: Optional[EmailMessage]
+
+
+def retry_delay(attempts: int) -> timedelta:
+    return min(EMAIL_BACKOFF * (2 ** (attempts - 1)), EMAIL_BACKOFF_MAX)
+
+
+def new_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def claim_due_emails(worker: str, limit: int) -> Tuple[int, List[OutboxJob]]:
+    """Lease up to `limit` due emails to this worker (committed) and build their messages.
+
+    Returns (claimed, jobs); mail that cannot be built is recorded as a failed
+    attempt at once, so jobs can be empty while claimed is not.
+    """
+    now = datetime.now()
+    with Session(engine) as session:
+        configs = email_configs_by_company(session)
+        if not configs:
+            return 0, []
+        ids = session.execute(
+            CLAIM_EMAILS_SQL, {"now": now, "worker": worker, "expired": now - EMAIL_LEASE, "limit": limit}
+        ).scalars().all()
+        session.commit()
+        if not ids:
+            return 0, []
+        rows = session.exec(select(EmailSetting).where(EmailSetting.id.in_(ids)).order_by(EmailSetting.id)).all()
+        jobs, unbuildable = [], []
+        for email in rows:
+            config = configs.get(email.companyid) or configs[None]
+            try:
+                jobs.append(OutboxJob(email.id, email.attempts, smtp_settings(config), build_email_message(config, email)))
+            except Exception as e:
+                # bad config or header (e.g. no SMTP host, CR/LF in an address): a failed
+                # attempt like any other, so it backs off and is dead-lettered in the end
+                unbuildable.append((OutboxJob(email.id, email.attempts, None, None), str(e) or e.__class__.__name__))
+    if unbuildable:
+        record_email_results(worker, unbuildable)
+    return len(ids), jobs
+
+
+def record_email_results(worker: str, results: List[Tuple[OutboxJob, Optional[str]]]) -> Tuple[int, int, int]:
+    """Write outcomes and release the lease in one executemany UPDATE; returns (sent, retried, deadlettered)."""
+    now = datetime.now()
+    rows, sent, retried, dead = [], 0, 0, 0
+    for job, error in results:
+        attempts = job.attempts + 1
+        if error is None:
+            sent += 1
+            rows.append({"b_id": job.id, "sent_status": True, "sent_at": now, "error": None,
+                         "attempts": attempts, "next_attempt_at": None, "deadletter": False})
+        elif attempts >= EMAIL_MAX_ATTEMPTS:
+            dead += 1
+            rows.append({"b_id": job.id, "sent_status": False, "sent_at": now, "error": error,
+                         "attempts": attempts, "next_attempt_at": None, "deadletter": True})
+        else:
+            retried += 1
+            rows.append({"b_id": job.id, "sent_status": False, "sent_at": now, "error": error,
+                         "attempts": attempts, "next_attempt_at": now + retry_delay(attempts),
+                         "deadletter": False})
+    if rows:
+        table = EmailSetting.__table__
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("b_id"), table.c.claimed_by == worker)
+            .values(claimed_at=None, claimed_by=None)
+        )
+        with Session(engine) as session:
+            session.execute(statement, rows)
+            session.commit()
+    return sent, retried, dead
+
+
+def _send(job: OutboxJob):
+    get_smtp_pool(job.settings).send(job.message)
+
+
+class EmailOutboxWorker:
+    def __init__(self, concurrency: int = EMAIL_CONCURRENCY):
+        self.concurrency = concurrency
+        self.workerid = new_worker_id()
+        self.task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._stopping = False
+        self.stats = {"startedon": None, "lastpollon": None, "sent": 0, "retried": 0, "deadlettered": 0,
+                      "lasterror": None}
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self, once: bool = False):
+        # Must be called from the event loop (startup hook or an async endpoint)
+        if self.running:
+            self.wake()
+            return
+        self._stopping = False
+        self.task = asyncio.get_running_loop().create_task(self.run(once=once))
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def stop(self):
+        self._stopping = True
+        self.wake()
+        if self.task is not None:
+            await self.task
+
+    async def run(self, once: bool = False):
+        """Poll and send until stopped; with once=True return when nothing is due."""
+        self._wake = asyncio.Event()
+        self.stats["startedon"] = datetime.now()
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                self.stats["lastpollon"] = datetime.now()
+                claimed, jobs = await asyncio.to_thread(claim_due_emails, self.workerid, EMAIL_BATCH)
+                if jobs:
+                    await self._send_batch(jobs)
+                if claimed:
+                    # more may be due, also when this batch could not be built at all
+                    continue
+            except Exception as e:
+                # database unavailable etc.: keep the worker alive, retry on the next poll
+                logger.exception("Email outbox poll failed")
+                self.stats["lasterror"] = str(e)
+            if once:
+                break
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=EMAIL_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_batch(self, jobs: List[OutboxJob]):
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(job: OutboxJob) -> Tuple[OutboxJob, Optional[str]]:
+            async with limit:
+                try:
+                    await asyncio.to_thread(_send, job)
+                    return job, None
+                except Exception as e:
+                    return job, str(e) or e.__class__.__name__
+
+        results = await asyncio.gather(*(send_one(job) for job in jobs))
+        sent, retried, dead = await asyncio.to_thread(record_email_results, self.workerid, results)
+        self.stats["sent"] += sent
+        self.stats["retried"] += retried
+        self.stats["deadlettered"] += dead
+        if retried or dead:
+            logger.warning("Email outbox: %s sent, %s to retry, %s dead-lettered", sent, retried, dead)
+
+
+outbox_worker = EmailOutboxWorker()
+
+
+def outbox_counts() -> Dict[str, int]:
+    with Session(engine) as session:
+        row = session.execute(text("""
+            SELECT COUNT(*) FILTER (WHERE sent_status) AS sent,
+                   COUNT(*) FILTER (WHERE NOT sent_status AND NOT deadletter
+                                    AND (next_attempt_at IS NULL OR next_attempt_at <= now())
+                                    AND (claimed_at IS NULL OR claimed_at < :expired)) AS due,
+                   COUNT(*) FILTER (WHERE NOT sent_status AND NOT deadletter
+                                    AND next_attempt_at > now()) AS retrying,
+                   COUNT(*) FILTER (WHERE deadletter) AS deadlettered,
+                   COUNT(*) FILTER (WHERE NOT sent_status AND claimed_at >= :expired) AS claimed
+            FROM email_settings
+        """), {"expired": datetime.now() - EMAIL_LEASE}).mappings().one()
+        return dict(row)
+
+
+@router.post("/sendpending")
+async def send_pending_emails():
+    # Returns at once; the worker drains the outbox in the background
+    counts = await asyncio.to_thread(outbox_counts)
+    outbox_worker.start(once=True)
+    return {"status": "queued", "worker_running": outbox_worker.running, "outbox": counts}
+
+
+@router.get("/email/outbox/status")
+async def email_outbox_status():
+    counts = await asyncio.to_thread(outbox_counts)
+    return {
+        "worker": {"id": outbox_worker.workerid, "running": outbox_worker.running, **outbox_worker.stats},
+        "outbox": counts,
+    }
+
+
+@router.post("/email/outbox/requeue")
+def requeue_dead_letters(emailid: Optional[int] = None):
+    # Put dead-lettered mail (one, or all) back in the outbox with a fresh attempt count
+    with Session(engine) as session:
+        statement = update(EmailSetting).where(EmailSetting.deadletter == True)
+        if emailid:
+            statement = statement.where(EmailSetting.id == emailid)
+        result = session.execute(
+            statement.values(deadletter=False, attempts=0, next_attempt_at=None, error=None,
+                             claimed_at=None, claimed_by=None)
+        )
+        session.commit()
+    if emailid and not result.rowcount:
+        raise HTTPException(status_code=404, detail="Dead-lettered email not found")
+    return {"detail": f"{result.rowcount} emails requeued"}
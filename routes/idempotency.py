@@ -0,0 +1,100 @@
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import JSONResponse
+from sqlmodel import Session, select, SQLModel, Field, Column, delete
+from sqlalchemy import UniqueConstraint, Index, JSON
+from sqlalchemy.dialects.postgresql import insert
+from .db import get_session
+from typing import Any, Optional
+from datetime import datetime, timedelta
+import hashlib
+import os
+
+
+router = APIRouter(tags=["Idempotency"])
+
+# How long a stored response is replayed for a repeated Idempotency-Key
+IDEMPOTENCY_TTL = timedelta(hours=int(os.getenv("PROBILL_IDEMPOTENCY_TTL_HOURS", "24")))
+
+
+class IdempotencyKey(SQLModel, table=True):
+    __tablename__ = "idempotency_key"
+    __table_args__ = (
+        UniqueConstraint("idemkey", "endpoint", name="uq_idempotency_key"),
+        Index("ix_idempotency_key_expireson", "expireson"),
+        {"extend_existing": True},
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    idemkey: str = Field(nullable=False)
+    endpoint: str = Field(nullable=False)
+    requesthash: str = Field(nullable=False)
+    statuscode: Optional[int] = None
+    response: Optional[Any] = Field(default=None, sa_column=Column(JSON))
+    createdon: datetime = Field(default_factory=datetime.now)
+    expireson: datetime = Field(nullable=False)
+
+
+def _request_hash(payload) -> str:
+    body = payload.model_dump_json() if hasattr(payload, "model_dump_json") else str(payload)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def claim_idempotency_key(
+    session: Session, idemkey: Optional[str], endpoint: str, payload
+) -> Optional[JSONResponse]:
+    """Claim a key in the caller's transaction, or return the stored response of an earlier request.
+
+    The claim row is inserted uncommitted, so a concurrent retry with the same key
+    waits on it and then replays whatever the first request committed. If the
+    first request rolls back, the claim disappears with it and the retry proceeds.
+    """
+    if not idemkey:
+        return None
+    table = IdempotencyKey.__table__
+    now = datetime.now()
+    requesthash = _request_hash(payload)
+
+    stmt = insert(table).values(
+        idemkey=idemkey, endpoint=endpoint, requesthash=requesthash,
+        createdon=now, expireson=now + IDEMPOTENCY_TTL,
+    )
+    # an expired key is reused as if it were new
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_idempotency_key",
+        set_={
+            "requesthash": requesthash, "statuscode": None, "response": None,
+            "createdon": now, "expireson": now + IDEMPOTENCY_TTL,
+        },
+        where=table.c.expireson < now,
+    ).returning(table.c.id)
+    if session.execute(stmt).first() is not None:
+        return None
+
+    stored = session.exec(
+        select(IdempotencyKey).where(
+            IdempotencyKey.idemkey == idemkey, IdempotencyKey.endpoint == endpoint
+        )
+    ).first()
+    if stored.requesthash != requesthash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+    return JSONResponse(status_code=stored.statuscode or 200, content=stored.response)
+
+
+def save_idempotent_response(
+    session: Session, idemkey: Optional[str], endpoint: str, response: Any, statuscode: int = 200
+):
+    # Call before the caller's commit so the document and its response land together
+    if not idemkey:
+        return
+    table = IdempotencyKey.__table__
+    session.execute(
+        table.update()
+        .where(table.c.idemkey == idemkey, table.c.endpoint == endpoint)
+        .values(statuscode=statuscode, response=response)
+    )
+
+
+@router.delete("/idempotency/purge")
+def purge_idempotency_keys(session: Session = Depends(get_session)):
+    result = session.exec(delete(IdempotencyKey).where(IdempotencyKey.expireson < datetime.now()))
+    session.commit()
+    return {"detail": f"{result.rowcount} expired idempotency keys removed"}
@@ -1,21 +1,48 @@
-from fastapi import  FastAPI, APIRouter, HTTPException, Depends,Query
+from fastapi import  FastAPI, APIRouter, HTTPException, Depends,Query,Body,Header,Response
 from sqlmodel import Session, select, SQLModel, Field ,delete ,func ,Table,MetaData,and_ 
-from sqlalchemy import  case,cast,Float
+from sqlalchemy import  case,cast,Float,Numeric,insert,update,Index,tuple_,text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from .db import engine, get_session
 #from sqlalchemy.orm import aliassed
-from pydantic import  validator, BaseModel ,EmailStr 
-from typing import List, Optional
+from pydantic import  validator, BaseModel ,EmailStr ,ValidationError
+from typing import List, Optional, Dict, Any
 from routes.commonflds import CommonFields  
 from datetime import datetime,date ,timedelta 
+from decimal import Decimal
+from types import SimpleNamespace
 from routes.company import Company  
 from routes.userauth import get_current_user
+from routes.docseries import next_document_no, allocate_document_nos, get_financial_year
+from routes.customer import CustomerHeader
+from routes.currecny import Currency
+from routes.product import ProductHeader
+from routes.uom import UOM
+from routes.taxmaster import TaxHeader, TaxMasterDetail
+from routes.invoicecalc import calculate_invoice, calculate_invoices, load_tax_rates, compute_header_totals
+from routes.paging import encode_cursor, decode_cursor
+from routes.idempotency import claim_idempotency_key, save_idempotent_response
+from routes.etag import make_etag, etag_matches, not_modified, set_etag
+from routes.ledger import sync_customer_ledger
 
 
 router = APIRouter( tags=["Invoice"])
 
 class InvoiceHeader(CommonFields, table=True):
     __tablename__ = "invoice_header"
-    __table_args__ = {"extend_existing": True} 
+    __table_args__ = (
+        # keyset paging/filters of /getinvoice (invoicedate DESC, id DESC)
+        Index("ix_invoice_header_company_date", "companyid", "invoicedate", "id"),
+        Index("ix_invoice_header_company_customer_date", "companyid", "customerid", "invoicedate", "id"),
+        # open (not fully paid) invoices of a customer, oldest first: receipt allocation
+        Index("ix_invoice_header_open", "companyid", "customerid", "invoicedate", "id",
+              postgresql_where=text("cancel = 'F' AND totnetamount > COALESCE(receiptamount, 0)")),
+        # receivables aging: index-only scan of a company's open invoices
+        Index("ix_invoice_header_aging", "companyid", "invoicedate",
+              postgresql_include=["customerid", "totnetamount", "receiptamount"],
+              postgresql_where=text("cancel = 'F' AND totnetamount > COALESCE(receiptamount, 0)")),
+        {"extend_existing": True},
+    )
     companyid: int = Field(foreign_key="company.id", nullable=False)
     companyno: str  
     invoiceno: str
@@ -39,6 +66,8 @@ class InvoiceHeader(CommonFields, table=True):
     receiptamount: Optional[float] = 0.00
     attachedfile: Optional[str] = None
     attachedfilename: Optional[str] = None
+    # bumped on every update; clients may send it back for optimistic locking
+    version: int = Field(default=1, nullable=False, sa_column_kwargs={"server_default": "1"})
     model_config = {
         "from_attributes": True,
         "json_encoders": {
@@ -50,7 +79,7 @@ class InvoiceDetails(SQLModel,table=True):
     __tablename__ = "invoice_details"
     __table_args__ = {"extend_existing": True} 
     id: Optional[int] = Field(default=None, primary_key=True)
-    invoice_headerid: int = Field(foreign_key="invoice_header.id", nullable=False)
+    invoice_headerid: int = Field(foreign_key="invoice_header.id", nullable=False, index=True)
     rowno: int = Field(default=1 )
     itemid: int = Field(foreign_key="product.id",nullable=False)
     uomid: int = Field(foreign_key="uom.id",nullable=False)
@@ -71,6 +100,48 @@ class InvoiceDetails(SQLModel,table=True):
     netamount:Optional[float] = None 
     afterdiscountamount:Optional[float] = None
 
+class InvoiceSearchIndex(SQLModel, table=True):
+    # One row per invoice with the searchable text, kept in step with invoice writes
+    __tablename__ = "invoice_search_index"
+    __table_args__ = (
+        Index("ix_invoice_search_index_company_date", "companyid", "invoicedate", "invoiceid"),
+        Index("ix_invoice_search_index_invoiceno_trgm", "invoiceno",
+              postgresql_using="gin", postgresql_ops={"invoiceno": "gin_trgm_ops"}),
+        Index("ix_invoice_search_index_customername_trgm", "customername",
+              postgresql_using="gin", postgresql_ops={"customername": "gin_trgm_ops"}),
+        Index("ix_invoice_search_index_invoicedatetext_trgm", "invoicedatetext",
+              postgresql_using="gin", postgresql_ops={"invoicedatetext": "gin_trgm_ops"}),
+        Index("ix_invoice_search_index_productnames_trgm", "productnames",
+              postgresql_using="gin", postgresql_ops={"productnames": "gin_trgm_ops"}),
+        {"extend_existing": True},
+    )
+    invoiceid: int = Field(foreign_key="invoice_header.id", primary_key=True, ondelete="CASCADE")
+    companyid: int = Field(nullable=False)
+    invoicedate: date
+    invoiceno: str = Field(default="")
+    customername: str = Field(default="")
+    invoicedatetext: str = Field(default="")
+    productnames: str = Field(default="")
+
+class InvoiceTaxSummary(SQLModel, table=True):
+    # Tax slab breakdown per invoice (what vw_invoice_footer aggregates), kept in
+    # step with invoice writes so footers and GST reports are indexed reads
+    __tablename__ = "invoice_tax_summary"
+    __table_args__ = (
+        Index("ix_invoice_tax_summary_company_date", "companyid", "invoicedate"),
+        Index("ix_invoice_tax_summary_invoiceno", "invoiceno"),
+        {"extend_existing": True},
+    )
+    invoiceid: int = Field(foreign_key="invoice_header.id", primary_key=True, ondelete="CASCADE")
+    taxslabname: str = Field(primary_key=True)
+    taxsupply: Optional[str] = None
+    taxrate: float = Field(default=0.0)
+    companyid: int = Field(nullable=False)
+    invoiceno: str = Field(default="")
+    invoicedate: date
+    taxableamount: float = Field(default=0.0)
+    taxamount: float = Field(default=0.0)
+
   #pydantic model For New Invoices 
 
 class CustomerView(SQLModel,table=True):
@@ -280,6 +351,7 @@ class UpdateInvoiceHeader(BaseModel):
     totnetamount:float
     attachedfile: Optional[str] = None
     attachedfilename: Optional[str] = None
+    version: Optional[int] = None
     invdetails: List[UpdateInvoiceDetails] = []
     model_config = {
         "from_attributes": True,
@@ -288,13 +360,65 @@ class UpdateInvoiceHeader(BaseModel):
         }
     }
 
+class InvoiceLineOp(BaseModel):
+  # op: "add", "modify" or "remove"; existing lines are addressed by id or rowno
+  op: str
+  id: Optional[int] = None
+  rowno: Optional[int] = None
+  itemid: Optional[int] = None
+  uomid: Optional[int] = None
+  invoiceqty: Optional[float] = None
+  invoicerate: Optional[float] = None
+  discounttype: Optional[str] = None
+  discount_amt_per: Optional[float] = None
+  taxheaderid: Optional[int] = None
+  taxrate: Optional[float] = None
+
+class InvoiceHeaderPatch(BaseModel):
+  # supplytype is not patchable: it changes the tax split of every line
+  invoicedate: Optional[date] = None
+  customerid: Optional[int] = None
+  referenceno: Optional[str] = None
+  referencedate: Optional[date] = None
+  currencyid: Optional[int] = None
+  exrate: Optional[float] = None
+  remarks: Optional[str] = None
+  add_othercharges: Optional[float] = None
+  ded_othercharges: Optional[float] = None
+  attachedfile: Optional[str] = None
+  attachedfilename: Optional[str] = None
+
+class InvoicePatch(BaseModel):
+  modifiedby: str
+  version: Optional[int] = None
+  header: Optional[InvoiceHeaderPatch] = None
+  lines: List[InvoiceLineOp] = []
+
+class InvoicePatchLine(BaseModel):
+  id: int
+  rowno: int
+
+class InvoicePatchResponse(BaseModel):
+  id: int
+  version: int
+  grossamount: float
+  discountamount: float
+  cgstamount: float
+  sgstamount: float
+  igstamount: float
+  roundedoff: float
+  totnetamount: float
+  added: List[InvoicePatchLine] = []
+
 class InvoiceResponse(BaseModel):
-    total:int
+    total: Optional[int] = None
     invoice_list: List[InvoiceView]
+    next_cursor: Optional[str] = None
 
 class InvoiceDetailResponse(BaseModel):
     invhdr: InvoiceView
     invdtl: List[InvoiceDetailView]
+    version: Optional[int] = None  # send back on /updateinvoice for optimistic locking
     model_config = {
         "from_attributes": True,
         "json_encoders": {
@@ -341,6 +465,14 @@ class InvoiceSearch(BaseModel):
     igstamount: Optional[float] = 0
     afterdiscountamount:Optional[float] = 0
 
+class InvoiceSearchGroup(BaseModel):
+    invhdr: InvoiceView
+    invdtl: List[InvoiceDetailView] = []
+
+class InvoiceSearchGroupedResponse(BaseModel):
+    results: List[InvoiceSearchGroup] = []
+    next_cursor: Optional[str] = None
+
 class InvoicePDFHeader(BaseModel):
     companyname: str
     adress: str
@@ -400,54 +532,39 @@ class InvoicePDFFooter(BaseModel):
     taxslabname: str | None
     footeramt: float | None
 
-def get_financial_year(invoice_date: date) -> str:
-    year = invoice_date.year
-    if invoice_date.month < 4:  # Jan, Feb, Mar → previous FY
-        start_year = year - 1
-        end_year = year
-    else:
-        start_year = year
-        end_year = year + 1
-    return f"{start_year}-{str(end_year)[2:]}"
+class BulkInvoiceResult(BaseModel):
+    index: int
+    id: Optional[int] = None
+    invoiceno: Optional[str] = None
+    error: Optional[str] = None
 
+class BulkInvoiceResponse(BaseModel):
+    total: int
+    inserted: int
+    failed: int
+    results: List[BulkInvoiceResult] = []
+
+
+@router.post("/invoice/calculate", response_model=PostInvoiceHeader)
+def preview_invoice_totals(payload: PostInvoiceHeader, session: Session = Depends(get_session)):
+    # Same calculation as /addinvoice applies on save, without saving
+    return calculate_invoice(session, payload)
 
 @router.post("/addinvoice", response_model=PostInvoiceHeader)
-def create_invoice(payload: PostInvoiceHeader, session: Session = Depends(get_session)):
+def create_invoice(payload: PostInvoiceHeader, session: Session = Depends(get_session),
+                   idempotency_key: Optional[str] = Header(default=None)):
+    # ✅ Step 0: A retried request replays the stored response
+    replay = claim_idempotency_key(session, idempotency_key, "/addinvoice", payload)
+    if replay is not None:
+        return replay
     try:
-        # ✅ Step 1: Determine Financial Year using invoice date
-        def get_financial_year(invoice_date: date):
-            year = invoice_date.year
-            if invoice_date.month < 4:  # Jan–Mar → previous FY
-                start_year = year - 1
-                end_year = year
-            else:
-                start_year = year
-                end_year = year + 1
-            return f"{start_year}-{str(end_year)[2:]}"  # e.g. 2025-26
-
-        finyr = get_financial_year(payload.invoicedate)
-
-        # ✅ Step 2: Get last invoice for same company & FY
-        last_invoice = session.exec(
-            select(InvoiceHeader)
-            .where(
-                InvoiceHeader.companyid == payload.companyid,
-                InvoiceHeader.invoiceno.like(f"INV/{finyr}-%")
-            )
-            .order_by(InvoiceHeader.id.desc())
-            .limit(1)
-        ).first()
-
-        # ✅ Step 3: Determine new invoice number
-        if last_invoice and last_invoice.invoiceno:
-            last_part = int(last_invoice.invoiceno.split("-")[-1])
-            new_no = last_part + 1
-        else:
-            new_no = 1
+        # ✅ Step 1: Derive line amounts and totals on the server
+        calculate_invoice(session, payload)
 
-        invoiceno = f"INV/{finyr}-{new_no:04d}"
+        # ✅ Step 2: Allocate invoice number from the company/FY counter
+        invoiceno = next_document_no(session, payload.companyid, "INV", payload.invoicedate)
 
-        # ✅ Step 4: Create Invoice Header
+        # ✅ Step 3: Create Invoice Header
         db_invoice = InvoiceHeader(
             companyid=payload.companyid,
             companyno=payload.companyno, 
@@ -478,7 +595,7 @@ def create_invoice(payload: PostInvoiceHeader, session: Session = Depends(get_se
         session.add(db_invoice)
         session.flush()  # ensures db_invoice.id is available
 
-        # ✅ Step 5: Add invoice details
+        # ✅ Step 4: Add invoice details
         for invdetails in payload.invdetails:
             db_invdetails = InvoiceDetails(
                 invoice_headerid=db_invoice.id,
@@ -500,10 +617,17 @@ def create_invoice(payload: PostInvoiceHeader, session: Session = Depends(get_se
                 gigstamount=invdetails.gigstamount,
                 taxamount=invdetails.taxamount,
                 netamount=invdetails.netamount,
+                afterdiscountamount=invdetails.afterdiscountamount,
             )
             session.add(db_invdetails)
+        session.flush()
+        refresh_invoice_derived(session, [db_invoice.id])
+        save_idempotent_response(
+            session, idempotency_key, "/addinvoice",
+            PostInvoiceHeader.model_validate(db_invoice).model_dump(mode="json"),
+        )
 
-        # ✅ Step 6: Commit everything
+        # ✅ Step 5: Commit everything
         session.commit()
         session.refresh(db_invoice)
         return db_invoice
@@ -512,6 +636,302 @@ def create_invoice(payload: PostInvoiceHeader, session: Session = Depends(get_se
         session.rollback()
         raise HTTPException(status_code=500, detail=f"Error saving Invoice: {str(e)}")
 
+def refresh_invoice_search(session: Session, invoice_ids: List[int]):
+    """Rebuild the search rows of the given invoices with one INSERT ... SELECT."""
+    if not invoice_ids:
+        return
+    h, cu, d, p = InvoiceHeader, CustomerHeader, InvoiceDetails, ProductHeader
+    source = (
+        select(
+            h.id,
+            h.companyid,
+            h.invoicedate,
+            h.invoiceno,
+            func.coalesce(cu.customername, ""),
+            func.to_char(h.invoicedate, "YYYY-MM-DD"),
+            func.coalesce(func.string_agg(p.productname.distinct(), " | "), ""),
+        )
+        .select_from(h)
+        .join(cu, cu.id == h.customerid, isouter=True)
+        .join(d, d.invoice_headerid == h.id, isouter=True)
+        .join(p, p.id == d.itemid, isouter=True)
+        .where(h.id.in_(invoice_ids))
+        .group_by(h.id, cu.customername)
+    )
+    cols = ["invoiceid", "companyid", "invoicedate", "invoiceno", "customername",
+            "invoicedatetext", "productnames"]
+    stmt = pg_insert(InvoiceSearchIndex).from_select(cols, source)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["invoiceid"],
+        set_={c: stmt.excluded[c] for c in cols if c != "invoiceid"},
+    )
+    session.execute(stmt)
+
+def refresh_invoice_tax_summary(session: Session, invoice_ids: List[int]):
+    """Replace the slab rows of the given invoices with one DELETE and one INSERT ... SELECT."""
+    if not invoice_ids:
+        return
+    h, d, td = InvoiceHeader, InvoiceDetails, TaxMasterDetail
+    taxable = func.coalesce(d.afterdiscountamount, d.invoiceamount, 0)
+    source = (
+        select(
+            h.id,
+            td.taxslabname,
+            func.min(td.taxsupply),
+            func.max(td.gtaxrate),
+            h.companyid,
+            h.invoiceno,
+            h.invoicedate,
+            func.sum(taxable),
+            # per line, rounded like the line amounts (half away from zero)
+            func.sum(func.round(cast(taxable * td.gtaxrate / 100, Numeric), 2)),
+        )
+        .select_from(h)
+        .join(d, d.invoice_headerid == h.id)
+        .join(td, and_(
+            td.taxheaderid == d.taxheaderid,
+            func.lower(td.taxsupply) == func.lower(h.supplytype),
+        ))
+        .where(h.id.in_(invoice_ids))
+        .group_by(h.id, td.taxslabname)
+    )
+    session.execute(delete(InvoiceTaxSummary).where(InvoiceTaxSummary.invoiceid.in_(invoice_ids)))
+    session.execute(
+        insert(InvoiceTaxSummary).from_select(
+            ["invoiceid", "taxslabname", "taxsupply", "taxrate", "companyid", "invoiceno",
+             "invoicedate", "taxableamount", "taxamount"],
+            source,
+        )
+    )
+
+def refresh_invoice_derived(session: Session, invoice_ids: List[int]):
+    # Tables derived from invoices; call in the same transaction as the invoice write
+    refresh_invoice_search(session, invoice_ids)
+    refresh_invoice_tax_summary(session, invoice_ids)
+    sync_customer_ledger(session, "INV", invoice_ids)
+
+BULK_INVOICE_CHUNK = 500
+
+def reindex_invoices_by_name(session: Session, customerid: Optional[int] = None, itemid: Optional[int] = None) -> int:
+    # Search rows carry customer and product names; refresh them after a rename
+    statement = select(InvoiceHeader.id)
+    if customerid is not None:
+        statement = statement.where(InvoiceHeader.customerid == customerid)
+    if itemid is not None:
+        statement = statement.where(
+            select(InvoiceDetails.id).where(
+                InvoiceDetails.invoice_headerid == InvoiceHeader.id, InvoiceDetails.itemid == itemid
+            ).exists()
+        )
+    ids = session.exec(statement).all()
+    for start in range(0, len(ids), BULK_INVOICE_CHUNK):
+        refresh_invoice_search(session, list(ids[start:start + BULK_INVOICE_CHUNK]))
+    return len(ids)
+
+def backfill_invoice_search() -> int:
+    # Startup: invoices saved before invoice_search_index existed have no search row
+    with Session(engine) as session:
+        ids = session.exec(
+            select(InvoiceHeader.id).where(
+                ~select(InvoiceSearchIndex.invoiceid)
+                .where(InvoiceSearchIndex.invoiceid == InvoiceHeader.id).exists()
+            )
+        ).all()
+        for start in range(0, len(ids), BULK_INVOICE_CHUNK):
+            refresh_invoice_search(session, list(ids[start:start + BULK_INVOICE_CHUNK]))
+            session.commit()
+        return len(ids)
+
+def backfill_invoice_tax_summary() -> int:
+    # Startup: invoices saved before invoice_tax_summary existed (or changed outside
+    # the API) have taxable lines but no slab rows; fill them in chunks
+    h, d, td = InvoiceHeader, InvoiceDetails, TaxMasterDetail
+    with Session(engine) as session:
+        ids = session.exec(
+            select(h.id).distinct()
+            .join(d, d.invoice_headerid == h.id)
+            .join(td, and_(
+                td.taxheaderid == d.taxheaderid,
+                func.lower(td.taxsupply) == func.lower(h.supplytype),
+            ))
+            .where(~select(InvoiceTaxSummary.invoiceid)
+                   .where(InvoiceTaxSummary.invoiceid == h.id).exists())
+        ).all()
+        for start in range(0, len(ids), BULK_INVOICE_CHUNK):
+            refresh_invoice_tax_summary(session, list(ids[start:start + BULK_INVOICE_CHUNK]))
+            session.commit()
+        return len(ids)
+
+def _invoice_header_row(payload: PostInvoiceHeader, invoiceno: str, now: datetime) -> Dict[str, Any]:
+    return {
+        "cancel": "F",
+        "sourceid": 0,
+        "createdby": payload.createdby,
+        "createdon": now,
+        "modifiedby": payload.modifiedby,
+        "modifiedon": now,
+        "app_desc": 1,
+        "app_level": 0,
+        "companyid": payload.companyid,
+        "companyno": payload.companyno,
+        "invoiceno": invoiceno,
+        "invoicedate": payload.invoicedate,
+        "customerid": payload.customerid,
+        "referenceno": payload.referenceno,
+        "referencedate": payload.referencedate,
+        "currencyid": payload.currencyid,
+        "exrate": payload.exrate,
+        "supplytype": payload.supplytype,
+        "remarks": payload.remarks,
+        "grossamount": payload.grossamount,
+        "sgstamount": payload.sgstamount,
+        "cgstamount": payload.cgstamount,
+        "igstamount": payload.igstamount,
+        "discountamount": payload.discountamount,
+        "add_othercharges": payload.add_othercharges,
+        "ded_othercharges": payload.ded_othercharges,
+        "roundedoff": payload.roundedoff,
+        "totnetamount": payload.totnetamount,
+        "receiptamount": 0.00,
+        "attachedfile": payload.attachedfile,
+        "attachedfilename": payload.attachedfilename,
+    }
+
+def _invoice_detail_rows(invoice_headerid: int, payload: PostInvoiceHeader) -> List[Dict[str, Any]]:
+    return [
+        {
+            "invoice_headerid": invoice_headerid,
+            **d.model_dump(exclude={"id", "invoice_headerid"}),
+        }
+        for d in payload.invdetails
+    ]
+
+def _insert_invoices(session: Session, invoices: List[PostInvoiceHeader]) -> List[tuple]:
+    """Number and insert invoices with one multi-row INSERT for headers and one for details.
+
+    Returns (id, invoiceno) per invoice, in the order given.
+    """
+    # One counter reservation per company + financial year
+    groups: Dict[tuple, List[int]] = {}
+    for pos, inv in enumerate(invoices):
+        groups.setdefault((inv.companyid, get_financial_year(inv.invoicedate)), []).append(pos)
+
+    numbers: List[Optional[str]] = [None] * len(invoices)
+    for (companyid, _), positions in groups.items():
+        nos = allocate_document_nos(
+            session, companyid, "INV", invoices[positions[0]].invoicedate, len(positions)
+        )
+        for pos, invoiceno in zip(positions, nos):
+            numbers[pos] = invoiceno
+
+    now = datetime.now()
+    header_ids = session.execute(
+        insert(InvoiceHeader).returning(InvoiceHeader.id, sort_by_parameter_order=True),
+        [_invoice_header_row(inv, numbers[pos], now) for pos, inv in enumerate(invoices)],
+    ).scalars().all()
+
+    detail_rows = [
+        row
+        for header_id, inv in zip(header_ids, invoices)
+        for row in _invoice_detail_rows(header_id, inv)
+    ]
+    if detail_rows:
+        session.execute(insert(InvoiceDetails), detail_rows)
+
+    refresh_invoice_derived(session, header_ids)
+    return list(zip(header_ids, numbers))
+
+def _check_invoice_references(session: Session, invoices: Dict[int, PostInvoiceHeader]) -> Dict[int, str]:
+    """Validate foreign keys of a whole batch with one query per master table."""
+    def existing(model, ids):
+        ids = {i for i in ids if i is not None}
+        if not ids:
+            return set()
+        return set(session.exec(select(model.id).where(model.id.in_(ids))).all())
+
+    customers = existing(CustomerHeader, (p.customerid for p in invoices.values()))
+    currencies = existing(Currency, (p.currencyid for p in invoices.values()))
+    items = existing(ProductHeader, (d.itemid for p in invoices.values() for d in p.invdetails))
+    uoms = existing(UOM, (d.uomid for p in invoices.values() for d in p.invdetails))
+    taxes = existing(TaxHeader, (d.taxheaderid for p in invoices.values() for d in p.invdetails))
+
+    errors: Dict[int, str] = {}
+    for idx, p in invoices.items():
+        problems = []
+        if p.customerid not in customers:
+            problems.append(f"customerid {p.customerid} not found")
+        if p.currencyid not in currencies:
+            problems.append(f"currencyid {p.currencyid} not found")
+        for d in p.invdetails:
+            if d.itemid not in items:
+                problems.append(f"row {d.rowno}: itemid {d.itemid} not found")
+            if d.uomid not in uoms:
+                problems.append(f"row {d.rowno}: uomid {d.uomid} not found")
+            if d.taxheaderid is not None and d.taxheaderid not in taxes:
+                problems.append(f"row {d.rowno}: taxheaderid {d.taxheaderid} not found")
+        if problems:
+            errors[idx] = "; ".join(problems)
+    return errors
+
+@router.post("/addinvoices/bulk", response_model=BulkInvoiceResponse)
+def create_invoices_bulk(
+    payload: List[Dict[str, Any]] = Body(...),
+    session: Session = Depends(get_session),
+):
+    results: Dict[int, BulkInvoiceResult] = {}
+    valid: Dict[int, PostInvoiceHeader] = {}
+
+    # ✅ Step 1: Validate each invoice on its own so one bad row doesn't reject the batch
+    for idx, raw in enumerate(payload):
+        try:
+            valid[idx] = PostInvoiceHeader.model_validate(raw)
+        except ValidationError as e:
+            results[idx] = BulkInvoiceResult(index=idx, error=str(e))
+
+    for idx, error in _check_invoice_references(session, valid).items():
+        results[idx] = BulkInvoiceResult(index=idx, error=error)
+        del valid[idx]
+
+    # Derive amounts for the whole batch in one pass
+    calculate_invoices(
+        list(valid.values()),
+        load_tax_rates(session, (d.taxheaderid for p in valid.values() for d in p.invdetails)),
+    )
+
+    # ✅ Step 2: Insert in chunks; a failing chunk is retried invoice by invoice
+    try:
+        pending = list(valid.items())
+        for start in range(0, len(pending), BULK_INVOICE_CHUNK):
+            chunk = pending[start:start + BULK_INVOICE_CHUNK]
+            try:
+                with session.begin_nested():
+                    inserted = _insert_invoices(session, [inv for _, inv in chunk])
+                for (idx, _), (invoiceid, invoiceno) in zip(chunk, inserted):
+                    results[idx] = BulkInvoiceResult(index=idx, id=invoiceid, invoiceno=invoiceno)
+            except SQLAlchemyError:
+                for idx, inv in chunk:
+                    try:
+                        with session.begin_nested():
+                            (invoiceid, invoiceno), = _insert_invoices(session, [inv])
+                        results[idx] = BulkInvoiceResult(index=idx, id=invoiceid, invoiceno=invoiceno)
+                    except SQLAlchemyError as e:
+                        results[idx] = BulkInvoiceResult(index=idx, error=str(getattr(e, "orig", e)))
+
+        # ✅ Step 3: Single commit for the whole batch
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise HTTPException(status_code=500, detail=f"Error saving Invoices: {str(e)}")
+
+    ordered = [results[idx] for idx in sorted(results)]
+    inserted_count = sum(1 for r in ordered if r.error is None)
+    return BulkInvoiceResponse(
+        total=len(payload),
+        inserted=inserted_count,
+        failed=len(payload) - inserted_count,
+        results=ordered,
+    )
+
 @router.post("/updateinvoice/{invoiceid}", response_model=UpdateInvoiceHeader)
 def update_invoice(
     invoiceid: int,
@@ -523,52 +943,323 @@ def update_invoice(
     if not db_invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
 
-    # --- Update header fields ---
-    for key, value in upd.model_dump(exclude={"invdetails"}).items():
-        setattr(db_invoice, key, value)
-
-    session.add(db_invoice)
-    session.flush()  # make sure it's updated before adding details
-
-    # --- Update details ---
-    if upd.invdetails:
-        for invdetails in upd.invdetails:
-            if invdetails.id:  # existing detail → update
-                db_detail = session.get(InvoiceDetails, invdetails.id)
-                if db_detail:
-                    for key, value in invdetails.model_dump(exclude_unset=True).items():
-                        setattr(db_detail, key, value)
-                    session.add(db_detail)
-                else:
-                    # detail.id given but not found → create new
-                    new_detail = InvoiceDetails(
-                        invoice_headerid=invoiceid,
-                        **invdetails.model_dump(exclude={"id","invoice_headerid"})
-                    )
-                    session.add(new_detail)
-            else:  # new detail → insert
-                new_detail = InvoiceDetails(
-                    invoice_headerid=invoiceid,
-                    **invdetails.model_dump(exclude={"id","invoice_headerid"})
-                )
-                session.add(new_detail)
+    detail = InvoiceDetails.__table__
+    existing = {
+        row["id"]: row
+        for row in session.execute(
+            select(detail).where(detail.c.invoice_headerid == invoiceid)
+        ).mappings()
+    }
 
+    # --- Derive line amounts and totals on the server ---
+    # A request without invdetails is a header-only edit: the stored lines stay as
+    # they are and the totals are summed from them
+    lines_given = "invdetails" in upd.model_fields_set
+    if lines_given:
+        calculate_invoice(session, upd)
+    else:
+        if upd.supplytype != db_invoice.supplytype:
+            raise HTTPException(
+                status_code=422, detail="Changing supplytype re-prices every line; send invdetails as well",
+            )
+        sums = [0.0] * len(INVOICE_TOTAL_PARTS)
+        for row in existing.values():
+            for i, v in enumerate(_line_contribution(row)):
+                sums[i] += v
+        totals = compute_header_totals(*sums, upd.add_othercharges or 0, upd.ded_othercharges or 0)
+        for field, value in totals.items():
+            setattr(upd, field, value)
+
+    # --- Update only the header fields that changed ---
+    changes = {
+        key: value
+        for key, value in upd.model_dump(exclude={"invdetails", "version"}).items()
+        if getattr(db_invoice, key) != value
+    }
+    # modifiedon/version move on every save, also for line-only edits
+    # (printed-copy caches are keyed on modifiedon)
+    stmt = (
+        update(InvoiceHeader)
+        .where(InvoiceHeader.id == invoiceid)
+        .values(**changes, modifiedon=datetime.now(), version=InvoiceHeader.version + 1)
+        .returning(InvoiceHeader.version)
+    )
+    if upd.version is not None:
+        stmt = stmt.where(InvoiceHeader.version == upd.version)
+    if session.execute(stmt, execution_options={"synchronize_session": False}).first() is None:
+        session.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail="Invoice was modified by someone else. Reload and try again.",
+        )
+
+    # --- Diff the lines against what is stored ---
+    to_insert, to_update, keep_ids = [], [], set(existing if not lines_given else ())
+    for line in upd.invdetails if lines_given else []:
+        current = existing.get(line.id) if line.id else None
+        if current is None:
+            # new line, or an id that does not belong to this invoice → insert
+            to_insert.append({
+                **line.model_dump(exclude={"id", "invoice_headerid"}),
+                "invoice_headerid": invoiceid,
+            })
+            continue
+        keep_ids.add(line.id)
+        changed = {
+            key: value
+            for key, value in line.model_dump(exclude_unset=True, exclude={"id", "invoice_headerid"}).items()
+            if current[key] != value
+        }
+        if changed:
+            to_update.append({"id": line.id, **changed})
+    to_delete = set(existing) - keep_ids
+
+    # --- Apply as set-based statements ---
+    if to_delete:
+        session.execute(delete(InvoiceDetails).where(InvoiceDetails.id.in_(to_delete)))
+    if to_update:
+        session.execute(update(InvoiceDetails), to_update)  # executemany, by primary key
+    if to_insert:
+        session.execute(insert(InvoiceDetails), to_insert)
+
+    refresh_invoice_derived(session, [invoiceid])
     session.commit()
     session.refresh(db_invoice)
     return db_invoice
 
 
+INVOICE_LINE_INPUTS = ("rowno", "itemid", "uomid", "invoiceqty", "invoicerate",
+                       "discounttype", "discount_amt_per", "taxheaderid", "taxrate")
+# a new line needs these; the columns are NOT NULL or the pricing depends on them
+INVOICE_LINE_REQUIRED = ("itemid", "uomid", "taxheaderid")
+INVOICE_TOTAL_PARTS = ("grossamount", "discountamount", "cgstamount", "sgstamount", "igstamount")
+
+def _line_contribution(line) -> List[float]:
+    # what one stored line adds to the header sums (same order as INVOICE_TOTAL_PARTS)
+    amount = line["invoiceamount"] or 0
+    after = line["afterdiscountamount"] if line["afterdiscountamount"] is not None else amount
+    return [amount, amount - after, line["gcgstamount"] or 0, line["gsgstamount"] or 0, line["gigstamount"] or 0]
+
+@router.patch("/invoice/{invoiceid}", response_model=InvoicePatchResponse)
+def patch_invoice(invoiceid: int, patch: InvoicePatch, session: Session = Depends(get_session)):
+    # ✅ Step 1: lock the header; totals are adjusted from its current values
+    db_invoice = session.exec(
+        select(InvoiceHeader).where(InvoiceHeader.id == invoiceid).with_for_update()
+    ).first()
+    if not db_invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    if patch.version is not None and patch.version != db_invoice.version:
+        raise HTTPException(
+            status_code=409,
+            detail="Invoice was modified by someone else. Reload and try again.",
+        )
+    if db_invoice.cancel == "T":
+        raise HTTPException(status_code=400, detail="Cancelled invoice cannot be changed")
+
+    # ✅ Step 2: validate, then load only the lines the operations address (one query)
+    header_fields = patch.header.model_dump(exclude_unset=True) if patch.header else {}
+    header_cols = InvoiceHeader.__table__.c
+    nulls = [k for k, v in header_fields.items() if v is None and not header_cols[k].nullable]
+    if nulls:
+        raise HTTPException(status_code=422, detail=f"Header fields cannot be null: {', '.join(nulls)}")
+    line_cols = InvoiceDetails.__table__.c
+    for op in patch.lines:
+        if op.op not in ("add", "modify", "remove"):
+            raise HTTPException(status_code=400, detail=f"Unknown line operation '{op.op}'")
+        if op.op != "add" and op.id is None and op.rowno is None:
+            raise HTTPException(status_code=400, detail=f"'{op.op}' needs a line id or rowno")
+        if op.op == "add":
+            missing = [k for k in INVOICE_LINE_REQUIRED if getattr(op, k) is None]
+            if missing:
+                raise HTTPException(status_code=400, detail=f"Line to add needs: {', '.join(missing)}")
+        nulls = [
+            k for k, v in op.model_dump(exclude_unset=True, exclude={"op", "id"}).items()
+            if v is None and not line_cols[k].nullable
+        ]
+        if nulls:
+            raise HTTPException(status_code=422, detail=f"Line fields cannot be null: {', '.join(nulls)}")
+    # masters named by the patch must exist (one query per master, as _check_invoice_references)
+    problems = []
+    for model, name, ids in (
+        (CustomerHeader, "customerid", {header_fields.get("customerid")}),
+        (Currency, "currencyid", {header_fields.get("currencyid")}),
+        (ProductHeader, "itemid", {op.itemid for op in patch.lines}),
+        (UOM, "uomid", {op.uomid for op in patch.lines}),
+        (TaxHeader, "taxheaderid", {op.taxheaderid for op in patch.lines}),
+    ):
+        ids.discard(None)
+        if ids:
+            found = set(session.exec(select(model.id).where(model.id.in_(ids))).all())
+            problems += [f"{name} {i} not found" for i in sorted(ids - found)]
+    if problems:
+        raise HTTPException(status_code=400, detail="; ".join(problems))
+    ref_ids = {op.id for op in patch.lines if op.op != "add" and op.id is not None}
+    ref_rows = {op.rowno for op in patch.lines if op.op != "add" and op.id is None}
+    detail = InvoiceDetails.__table__
+    by_id, by_rowno = {}, {}
+    if ref_ids or ref_rows:
+        for row in session.execute(
+            select(detail).where(
+                detail.c.invoice_headerid == invoiceid,
+                detail.c.id.in_(ref_ids) | detail.c.rowno.in_(ref_rows),
+            )
+        ).mappings():
+            by_id[row["id"]] = row
+            by_rowno.setdefault(row["rowno"], []).append(row)
+
+    # ✅ Step 3: apply the operations in memory, tracking the old contribution
+    removed, touched, added = {}, {}, []
+    next_rowno = None
+    for op in patch.lines:
+        fields = op.model_dump(exclude_unset=True, exclude={"op", "id"})
+        if op.op == "add":
+            if "rowno" not in fields:
+                if next_rowno is None:
+                    next_rowno = (session.exec(
+                        select(func.max(InvoiceDetails.rowno)).where(InvoiceDetails.invoice_headerid == invoiceid)
+                    ).first() or 0) + 1
+                fields["rowno"] = next_rowno
+                next_rowno += 1
+            try:
+                added.append(UpdateInvoiceDetails(**fields))
+            except ValidationError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid line to add: {e.errors()}")
+            continue
+
+        if op.id is not None:
+            row = by_id.get(op.id)
+        else:
+            matches = by_rowno.get(op.rowno, [])
+            if len(matches) > 1:
+                raise HTTPException(status_code=400, detail=f"rowno {op.rowno} is not unique, use the line id")
+            row = matches[0] if matches else None
+        if row is None or row["id"] in removed:
+            raise HTTPException(status_code=404, detail=f"Line {op.id or op.rowno} not found")
+
+        if op.op == "remove":
+            removed[row["id"]] = row
+            touched.pop(row["id"], None)
+        else:
+            current = touched.get(row["id"])
+            if current is None:
+                try:
+                    current = UpdateInvoiceDetails(**{k: row[k] for k in INVOICE_LINE_INPUTS}, id=row["id"])
+                except ValidationError as e:
+                    raise HTTPException(
+                        status_code=422,
+                        detail=f"Stored line {row['id']} is incomplete, use a full update: {e.errors()}",
+                    )
+            if op.id is None:
+                fields.pop("rowno")  # the address, not a change
+            touched[row["id"]] = current.model_copy(update=fields)
+
+    # ✅ Step 4: price the new/changed lines only, then adjust the header sums
+    old_parts = [0.0] * len(INVOICE_TOTAL_PARTS)
+    for line_id in list(removed) + list(touched):
+        for i, v in enumerate(_line_contribution(by_id[line_id])):
+            old_parts[i] += v
+
+    changed = SimpleNamespace(
+        supplytype=db_invoice.supplytype,
+        invdetails=list(touched.values()) + added,
+        add_othercharges=0,
+        ded_othercharges=0,
+    )
+    calculate_invoice(session, changed)  # header sums of `changed` = contribution of these lines
+
+    sums = [
+        (getattr(db_invoice, part) or 0) - old + getattr(changed, part)
+        for part, old in zip(INVOICE_TOTAL_PARTS, old_parts)
+    ]
+    totals = compute_header_totals(
+        *sums,
+        header_fields.get("add_othercharges", db_invoice.add_othercharges) or 0,
+        header_fields.get("ded_othercharges", db_invoice.ded_othercharges) or 0,
+    )
+
+    # ✅ Step 5: set-based writes, header last
+    if removed:
+        session.execute(delete(InvoiceDetails).where(InvoiceDetails.id.in_(list(removed))))
+    if touched:
+        session.execute(
+            update(InvoiceDetails),
+            [line.model_dump(exclude={"invoice_headerid"}) for line in touched.values()],
+        )
+    new_ids = []
+    if added:
+        new_ids = session.execute(
+            insert(InvoiceDetails).returning(InvoiceDetails.id, sort_by_parameter_order=True),
+            [{**line.model_dump(exclude={"id"}), "invoice_headerid": invoiceid} for line in added],
+        ).scalars().all()
+
+    version = session.execute(
+        update(InvoiceHeader)
+        .where(InvoiceHeader.id == invoiceid)
+        .values(**header_fields, **totals, modifiedby=patch.modifiedby,
+                modifiedon=datetime.now(), version=InvoiceHeader.version + 1)
+        .returning(InvoiceHeader.version)
+        .execution_options(synchronize_session=False)
+    ).scalar_one()
+    refresh_invoice_derived(session, [invoiceid])
+    session.commit()
+
+    return InvoicePatchResponse(
+        id=invoiceid,
+        version=version,
+        **totals,
+        added=[InvoicePatchLine(id=i, rowno=line.rowno) for i, line in zip(new_ids, added)],
+    )
+
+
+INVOICE_SEARCH_FIELDS = {
+    "customername": InvoiceSearchIndex.customername,
+    "invoiceno": InvoiceSearchIndex.invoiceno,
+    "invoicedate": InvoiceSearchIndex.invoicedatetext,
+    "productname": InvoiceSearchIndex.productnames,
+}
+
+def _contains_pattern(value: str) -> str:
+    # ILIKE pattern for a literal substring (escape "\\")
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def _search_invoices(db: Session, companyid: int, field: str, value: str, limit: int, after: Optional[list] = None):
+    """Ranked (invoiceid, score, invoicedate) rows, best match first."""
+    if field not in INVOICE_SEARCH_FIELDS:
+        raise HTTPException(status_code=400, detail="Invalid search field")
+    si = InvoiceSearchIndex
+    column = INVOICE_SEARCH_FIELDS[field]
+    # similarity() is a real; as numeric it compares equal to itself after the
+    # round trip through the cursor, so ties on the last row are not skipped
+    score = cast(func.similarity(column, value), Numeric(7, 6))
+    statement = (
+        select(si.invoiceid, score.label("score"), si.invoicedate)
+        .where(si.companyid == companyid, column.ilike(_contains_pattern(value), escape="\\"))
+        .order_by(score.desc(), si.invoicedate.desc(), si.invoiceid.desc())
+        .limit(limit)
+    )
+    if after:
+        statement = statement.where(tuple_(score, si.invoicedate, si.invoiceid) < tuple_(*after))
+    return db.exec(statement).all()
+
 @router.get("/invoice/search/{companyid}", response_model=List[InvoiceSearch])
 def invoice_search(
     companyid: int,
     field: str = Query(...),
     value: str = Query(...),
+    limit: int = Query(50, ge=1, le=500),
     db: Session = Depends(get_session),
 ):
     c = InvoiceView
     d = InvoiceDetailView
     comp = Company
 
+    # Find the best matching invoices on the trigram-indexed search table
+    matches = [m.invoiceid for m in _search_invoices(db, companyid, field, value, limit)]
+    if not matches:
+        return []
+    rank = {invoiceid: pos for pos, invoiceid in enumerate(matches)}
+
     # Base query with joins
     query = (
         db.query(
@@ -600,23 +1291,14 @@ def invoice_search(
         )
         .join(comp, c.companyid == comp.id, isouter=True)
         .join(d, c.id == d.invoice_headerid, isouter=True)
-        .filter(comp.id == companyid)
+        .filter(c.id.in_(matches))
     )
 
-    # Dynamic filter
-    field_map = {
-        "customername": c.customername,
-        "invoiceno": c.invoiceno,
-        "invoicedate": c.invoicedate,
-        "productname": d.productname,
-    }
+    # Only the matching lines when searching by product
+    if field == "productname":
+        query = query.filter(d.productname.ilike(_contains_pattern(value), escape="\\"))
 
-    if field not in field_map:
-        raise HTTPException(status_code=400, detail="Invalid search field")
-
-    query = query.filter(field_map[field].ilike(f"%{value}%"))
-
-    results = query.all()
+    results = sorted(query.all(), key=lambda row: rank[row[0].id])
 
     response_data = []
     for row in results:
@@ -663,44 +1345,197 @@ def invoice_search(
 
 
 
+INVOICE_SEARCH_GROUPED_MAX = 100
+
+@router.get("/invoice/searchgrouped/{companyid}", response_model=InvoiceSearchGroupedResponse)
+def invoice_search_grouped(
+    companyid: int,
+    field: str = Query(...),
+    value: str = Query(...),
+    limit: int = Query(20, ge=1, le=INVOICE_SEARCH_GROUPED_MAX),
+    cursor: Optional[str] = None,
+    withlines: bool = False,
+    db: Session = Depends(get_session),
+):
+    # One entry per invoice: header once, then only the lines that matched
+    # (all lines only when withlines=true for header-field searches)
+    after = decode_cursor(cursor, Decimal, date, int) if cursor else None
+    matches = _search_invoices(db, companyid, field, value, limit + 1, after)
+
+    next_cursor = None
+    if len(matches) > limit:
+        matches = matches[:limit]
+        last = matches[-1]
+        next_cursor = encode_cursor(str(last.score), last.invoicedate, last.invoiceid)
+    if not matches:
+        return InvoiceSearchGroupedResponse(results=[])
+
+    ids = [m.invoiceid for m in matches]
+    headers = {h.id: h for h in db.exec(select(InvoiceView).where(InvoiceView.id.in_(ids))).all()}
+
+    lines: Dict[int, list] = {}
+    if field == "productname" or withlines:
+        statement = (
+            select(InvoiceDetailView)
+            .where(InvoiceDetailView.invoice_headerid.in_(ids))
+            .order_by(InvoiceDetailView.invoice_headerid, InvoiceDetailView.rowno)
+        )
+        if field == "productname":
+            statement = statement.where(
+                InvoiceDetailView.productname.ilike(_contains_pattern(value), escape="\\")
+            )
+        for line in db.exec(statement).all():
+            lines.setdefault(line.invoice_headerid, []).append(line)
+
+    return InvoiceSearchGroupedResponse(
+        results=[
+            InvoiceSearchGroup(invhdr=headers[i], invdtl=lines.get(i, []))
+            for i in ids if i in headers
+        ],
+        next_cursor=next_cursor,
+    )
+
+@router.post("/invoice/search/reindex/{companyid}")
+def reindex_invoice_search(companyid: int, session: Session = Depends(get_session)):
+    # Rebuild after bulk imports or customer/product renames
+    ids = session.exec(select(InvoiceHeader.id).where(InvoiceHeader.companyid == companyid)).all()
+    refresh_invoice_search(session, list(ids))
+    session.commit()
+    return {"detail": f"Search index rebuilt for {len(ids)} invoices"}
+
 @router.get("/getinvoice/{companyid}", response_model=InvoiceResponse)
 def read_invoice(
     companyid: int,
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,
+    fromdate: Optional[date] = None,
+    todate: Optional[date] = None,
+    customerid: Optional[int] = None,
+    cancel: Optional[str] = None,
+    outstanding: Optional[bool] = None,
+    withtotal: bool = True,
     session: Session = Depends(get_session),
      current_user: dict = Depends(get_current_user)
 ):
     c = InvoiceView
 
-    # Fetch paginated customers
-    invoice_header = session.exec(
-        select(c)
-        .where( c.companyid == companyid)
-        .order_by(c.invoiceno.desc())
-        .offset(skip)
-        .limit(limit)
-    ).all()
+    # Filters
+    conditions = [c.companyid == companyid]
+    if fromdate:
+        conditions.append(c.invoicedate >= fromdate)
+    if todate:
+        conditions.append(c.invoicedate <= todate)
+    if customerid:
+        conditions.append(c.customerid == customerid)
+    if cancel:
+        conditions.append(c.cancel == cancel)
+    if outstanding is not None:
+        balance = c.totnetamount - func.coalesce(c.receiptamount, 0)
+        conditions.append(balance > 0 if outstanding else balance <= 0)
+
+    # Newest first; a cursor continues after the last row of the previous page
+    statement = select(c).where(*conditions).order_by(c.invoicedate.desc(), c.id.desc())
+    if cursor:
+        last_date, last_id = decode_cursor(cursor, date, int)
+        statement = statement.where(tuple_(c.invoicedate, c.id) < tuple_(last_date, last_id))
+    else:
+        statement = statement.offset(skip)
+
+    invoice_header = session.exec(statement.limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(invoice_header) > limit:
+        invoice_header = invoice_header[:limit]
+        last = invoice_header[-1]
+        next_cursor = encode_cursor(last.invoicedate, last.id)
 
     if not invoice_header:
         #raise HTTPException(status_code=404, detail="Invoice not found")
-        return InvoiceResponse(total=0,invoice_list=[])
+        return InvoiceResponse(total=0 if withtotal else None, invoice_list=[])
 
-    # Total count
-    totalcount = session.exec(
-        select(func.count(c.id)).where(c.companyid == companyid)
-    ).first() or 0
+    # Total count (optional, it is the expensive part on large companies)
+    totalcount = None
+    if withtotal:
+        totalcount = session.exec(
+            select(func.count(c.id)).where(*conditions)
+        ).first() or 0
 
     # Response
     return InvoiceResponse(
         total=totalcount,
-        invoice_list=invoice_header
+        invoice_list=invoice_header,
+        next_cursor=next_cursor,
     )
 
+def invoice_etag(session: Session, invoiceid: int):
+    """(etag, version) of an invoice from one indexed lookup, or None if it does not exist."""
+    h, d = InvoiceHeader, InvoiceDetails
+    row = session.exec(
+        select(h.modifiedon, h.version, func.count(d.id), func.max(d.id))
+        .select_from(h)
+        .join(d, d.invoice_headerid == h.id, isouter=True)
+        .where(h.id == invoiceid)
+        .group_by(h.id)
+    ).first()
+    if row is None:
+        return None
+    modifiedon, version, lines, lastline = row
+    return make_etag("inv", invoiceid, modifiedon.isoformat(), version, lines, lastline), version
+
+INVOICE_BATCH_MAX = 500
+
+# Declared before /getinvoicedtl/{invoiceid} so "batch" is not taken for an id
+@router.get("/getinvoicedtl/batch", response_model=List[InvoiceDetailResponse])
+def get_invdetails_batch(
+    ids: List[str] = Query(..., description="Invoice ids, comma separated or repeated"),
+    session: Session = Depends(get_session),
+):
+    try:
+        invoice_ids = list(dict.fromkeys(int(i) for part in ids for i in part.split(",") if i.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be integers")
+    if len(invoice_ids) > INVOICE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {INVOICE_BATCH_MAX} invoices per request")
+    if not invoice_ids:
+        return []
+
+    # ✅ Query 1: all headers (with their version)
+    headers = session.exec(
+        select(InvoiceView, InvoiceHeader.version)
+        .join(InvoiceHeader, InvoiceHeader.id == InvoiceView.id)
+        .where(InvoiceView.id.in_(invoice_ids))
+    ).all()
+
+    # ✅ Query 2: all lines, grouped per invoice in memory
+    lines: Dict[int, List[InvoiceDetails]] = {}
+    for d in session.exec(
+        select(InvoiceDetails)
+        .where(InvoiceDetails.invoice_headerid.in_(invoice_ids))
+        .order_by(InvoiceDetails.invoice_headerid, InvoiceDetails.rowno)
+    ).all():
+        lines.setdefault(d.invoice_headerid, []).append(d)
+
+    found = {hdr.id: (hdr, version) for hdr, version in headers}
+    return [
+        InvoiceDetailResponse(invhdr=found[i][0], invdtl=lines.get(i, []), version=found[i][1])
+        for i in invoice_ids if i in found
+    ]
+
 @router.get("/getinvoicedtl/{invoiceid}",response_model=InvoiceDetailResponse)
-def get_invdetails(invoiceid: int, session: Session = Depends(get_session),
+def get_invdetails(invoiceid: int, response: Response, session: Session = Depends(get_session),
+                  if_none_match: Optional[str] = Header(default=None),
                   #current_user: dict = Depends(get_current_user)
                  ):
+    # Cheap validator first; unchanged documents are answered with 304
+    current = invoice_etag(session, invoiceid)
+    if current is None:
+        raise HTTPException(status_code=404, detail="Invoice header not found")
+    etag, version = current
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+
     inv_header = session.get(InvoiceView, invoiceid)
     if not inv_header:
         raise HTTPException(status_code=404, detail="Invoice header not found")
@@ -713,7 +1548,7 @@ def get_invdetails(invoiceid: int, session: Session = Depends(get_session),
     results = session.exec(statement) 
     inv_details = results.all()
 
-    return InvoiceDetailResponse(invhdr=inv_header, invdtl=inv_details)
+    return InvoiceDetailResponse(invhdr=inv_header, invdtl=inv_details, version=version)
 
   
 
@@ -830,20 +1665,15 @@ def get_pdfdtl(invoiceno: str, session: Session = Depends(get_session)):
 
 @router.get("/getinvfooterpdf", response_model=List[InvoicePDFFooter])
 def get_pdffooter(invoiceno: str, session: Session = Depends(get_session)):
-   
+
+    # Slab totals are maintained in invoice_tax_summary on every invoice write
     statement = (
-        select(
-            InvoiceFooter.id,
-            InvoiceFooter.invoiceno,
-            InvoiceFooter.taxslabname,
-            func.sum(InvoiceFooter.footeramt).label("footeramt")
-        )
+        select(InvoiceTaxSummary.taxsupply, InvoiceTaxSummary.taxslabname, InvoiceTaxSummary.taxamount)
         .where(
-            InvoiceFooter.invoiceno == invoiceno,
-            InvoiceFooter.footeramt > 0
+            InvoiceTaxSummary.invoiceno == invoiceno,
+            InvoiceTaxSummary.taxamount > 0
         )
-        .group_by(InvoiceFooter.taxslabname,InvoiceFooter.id, InvoiceFooter.invoiceno)
-        .order_by( InvoiceFooter.id.desc() )
+        .order_by(InvoiceTaxSummary.taxslabname)
     )
 
     results = session.exec(statement).all()
@@ -852,11 +1682,61 @@ def get_pdffooter(invoiceno: str, session: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Invoice Footer not found")
 
     return [
-        {"taxslabname": r.taxslabname, "footeramt": r.footeramt}
+        {"taxsupply": r.taxsupply, "taxslabname": r.taxslabname, "footeramt": r.taxamount}
         for r in results
     ]
 
 
+class TaxSlabReport(BaseModel):
+    taxsupply: Optional[str] = None
+    taxslabname: str
+    taxrate: float
+    invoices: int
+    taxableamount: float
+    taxamount: float
+
+
+@router.get("/invoice/taxsummary/{companyid}", response_model=List[TaxSlabReport])
+def tax_slab_report(
+    companyid: int,
+    fromdate: date = Query(...),
+    todate: date = Query(...),
+    session: Session = Depends(get_session),
+):
+    # GST slab-wise totals for a period, excluding cancelled invoices
+    t = InvoiceTaxSummary
+    statement = (
+        select(
+            t.taxsupply,
+            t.taxslabname,
+            t.taxrate,
+            func.count(func.distinct(t.invoiceid)).label("invoices"),
+            func.sum(t.taxableamount).label("taxableamount"),
+            func.sum(t.taxamount).label("taxamount"),
+        )
+        .join(InvoiceHeader, InvoiceHeader.id == t.invoiceid)
+        .where(
+            t.companyid == companyid,
+            t.invoicedate >= fromdate,
+            t.invoicedate <= todate,
+            InvoiceHeader.cancel != "T",
+        )
+        .group_by(t.taxsupply, t.taxslabname, t.taxrate)
+        .order_by(t.taxsupply, t.taxrate, t.taxslabname)
+    )
+    return [TaxSlabReport(**r._mapping) for r in session.exec(statement).all()]
+
+
+@router.post("/invoice/taxsummary/rebuild/{companyid}")
+def rebuild_invoice_tax_summary(companyid: int, session: Session = Depends(get_session)):
+    # Rebuild after tax master changes or data fixed directly in the database
+    ids = session.exec(select(InvoiceHeader.id).where(InvoiceHeader.companyid == companyid)).all()
+    for start in range(0, len(ids), BULK_INVOICE_CHUNK):
+        refresh_invoice_tax_summary(session, list(ids[start:start + BULK_INVOICE_CHUNK]))
+    session.commit()
+    return {"detail": f"Tax summary rebuilt for {len(ids)} invoices"}
+
+
     
 @router.delete("/invoicedelete/{invoiceid}", response_model=dict)
 def delete_invoice(invoiceid: int, session: Session = Depends(get_session)):    
@@ -864,12 +1744,11 @@ def delete_invoice(invoiceid: int, session: Session = Depends(get_session)):
     if not db_tax:
         raise HTTPException(status_code=404, detail="Invoice not found")
 
-    # Delete associated tax details first
+    # Delete lines and header in one transaction (derived rows cascade)
     session.exec(delete(InvoiceDetails).where(InvoiceDetails.invoice_headerid == invoiceid))
-    session.commit()
-
-    # Delete the tax header
     session.delete(db_tax)
+    session.flush()
+    sync_customer_ledger(session, "INV", [invoiceid])
     session.commit()
 
     return {"detail": "Invoice deleted successfully"}
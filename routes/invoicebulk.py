@@ -0,0 +1,133 @@
+from fastapi import APIRouter, HTTPException, Depends
+from sqlmodel import Session, select, delete
+from sqlalchemy import update
+from pydantic import BaseModel
+from .db import get_session
+from typing import List, Optional
+from datetime import datetime, date
+from routes.invoice import InvoiceHeader, InvoiceDetails, BULK_INVOICE_CHUNK, refresh_invoice_derived
+from routes.receipts import ReceiptsHeader, ReceiptsDetail, refresh_invoice_receipt_amounts
+from routes.ledger import sync_customer_ledger
+
+
+router = APIRouter(tags=["Invoice"])
+
+# Bulk delete / cancel. The selected invoices are processed BULK_INVOICE_CHUNK at a
+# time, each chunk in its own transaction with set-based statements, so row locks
+# are held only for the duration of one chunk.
+
+
+class BulkInvoiceAction(BaseModel):
+    companyid: int
+    modifiedby: str
+    action: str = "cancel"  # "cancel" or "delete"
+    invoiceids: Optional[List[int]] = None
+    fromdate: Optional[date] = None
+    todate: Optional[date] = None
+    customerid: Optional[int] = None
+
+
+class BulkInvoiceSkipped(BaseModel):
+    id: int
+    invoiceno: str
+    reason: str
+
+
+class BulkInvoiceActionResponse(BaseModel):
+    action: str
+    total: int
+    processed: int
+    skipped: List[BulkInvoiceSkipped] = []
+
+
+def _select_invoices(session: Session, payload: BulkInvoiceAction) -> List[tuple]:
+    inv = InvoiceHeader
+    query = select(inv.id, inv.invoiceno).where(inv.companyid == payload.companyid)
+    if payload.invoiceids:
+        query = query.where(inv.id.in_(payload.invoiceids))
+    if payload.fromdate:
+        query = query.where(inv.invoicedate >= payload.fromdate)
+    if payload.todate:
+        query = query.where(inv.invoicedate <= payload.todate)
+    if payload.customerid:
+        query = query.where(inv.customerid == payload.customerid)
+    if payload.action == "cancel":
+        query = query.where(inv.cancel != "T")
+    return session.exec(query.order_by(inv.id)).all()
+
+
+def _invoices_with_receipts(session: Session, ids: List[int], active_only: bool) -> set:
+    query = (
+        select(ReceiptsDetail.invoiceno)
+        .join(ReceiptsHeader, ReceiptsHeader.id == ReceiptsDetail.receiptheaderid)
+        .where(ReceiptsDetail.invoiceno.in_(ids))
+        .distinct()
+    )
+    if active_only:
+        query = query.where(ReceiptsHeader.cancel != "T")
+    return set(session.exec(query).all())
+
+
+@router.post("/invoices/bulkaction", response_model=BulkInvoiceActionResponse)
+def bulk_invoice_action(payload: BulkInvoiceAction, session: Session = Depends(get_session)):
+    if payload.action not in ("cancel", "delete"):
+        raise HTTPException(status_code=400, detail="action must be 'cancel' or 'delete'")
+    if not payload.invoiceids and not (payload.fromdate and payload.todate):
+        raise HTTPException(status_code=400, detail="Give invoiceids or fromdate and todate")
+
+    # ✅ Step 1: resolve the target set once
+    targets = _select_invoices(session, payload)
+    session.rollback()  # end the read transaction before the chunked writes
+
+    processed = 0
+    skipped: List[BulkInvoiceSkipped] = []
+    for start in range(0, len(targets), BULK_INVOICE_CHUNK):
+        chunk = targets[start:start + BULK_INVOICE_CHUNK]
+
+        # ✅ Step 2: lock the chunk's invoices, so no receipt can be posted against
+        # them between the check below and the write (its FK check waits for us)
+        ids = session.exec(
+            select(InvoiceHeader.id)
+            .where(InvoiceHeader.id.in_([r.id for r in chunk]))
+            .order_by(InvoiceHeader.id)
+            .with_for_update()
+        ).all()
+
+        # leave out invoices that receipts still point at
+        # (a delete is blocked by any receipt row, a cancel only by live receipts)
+        blocked = _invoices_with_receipts(session, ids, active_only=payload.action == "cancel")
+        skipped.extend(
+            BulkInvoiceSkipped(id=r.id, invoiceno=r.invoiceno, reason="Invoice has receipts")
+            for r in chunk if r.id in blocked
+        )
+        ids = [i for i in ids if i not in blocked]
+        if not ids:
+            session.rollback()  # release the chunk's locks
+            continue
+
+        # ✅ Step 3: set-based write, then dependent amounts, one commit per chunk
+        if payload.action == "delete":
+            session.exec(delete(InvoiceDetails).where(InvoiceDetails.invoice_headerid.in_(ids)))
+            session.exec(delete(InvoiceHeader).where(InvoiceHeader.id.in_(ids)))
+            # search and tax-summary rows go with the header (ON DELETE CASCADE)
+            sync_customer_ledger(session, "INV", ids)
+        else:
+            session.execute(
+                update(InvoiceHeader)
+                .where(InvoiceHeader.id.in_(ids), InvoiceHeader.cancel != "T")
+                .values(
+                    cancel="T",
+                    modifiedby=payload.modifiedby,
+                    modifiedon=datetime.now(),
+                    version=InvoiceHeader.version + 1,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            refresh_invoice_receipt_amounts(session, ids)
+            refresh_invoice_derived(session, ids)
+        session.commit()
+        processed += len(ids)
+
+    return BulkInvoiceActionResponse(
+        action=payload.action, total=len(targets), processed=processed, skipped=skipped
+    )
@@ -0,0 +1,162 @@
+from sqlmodel import Session, select
+from typing import Dict, Iterable, List, Optional
+from routes.taxmaster import TaxHeader
+import math
+
+# Invoice calculation engine.
+#
+# Lines are processed column-wise: the quantities, rates, discounts and tax rates
+# of every line of every invoice in a batch are pulled into flat lists once, each
+# derived column is computed with a single comprehension over those lists, and
+# the results are written back. Header totals are summed per invoice from the
+# line columns.
+
+PERCENT_DISCOUNT_TYPES = {"%", "P", "PER", "PERCENT", "PERCENTAGE"}
+
+LINE_FIELDS = (
+    "invoiceamount", "afterdiscountamount", "taxrate", "cgstper", "sgstper", "igstper",
+    "gcgstamount", "gsgstamount", "gigstamount", "taxamount", "netamount",
+)
+
+
+def _r2(value: float) -> float:
+    # Half-up rounding to paise (round() would round half to even)
+    return math.copysign(math.floor(abs(value) * 100 + 0.5 + 1e-9) / 100, value)
+
+
+def round_amount(value: float) -> float:
+    """Round a money amount to paise, half-up like the invoice engine."""
+    return _r2(value)
+
+
+def is_interstate(supplytype: Optional[str]) -> bool:
+    return (supplytype or "").strip().lower().startswith("inter")
+
+
+def is_percent_discount(discounttype: Optional[str]) -> bool:
+    return (discounttype or "").strip().upper() in PERCENT_DISCOUNT_TYPES
+
+
+def load_tax_rates(session: Session, taxheaderids: Iterable[Optional[int]]) -> Dict[int, float]:
+    ids = {i for i in taxheaderids if i}
+    if not ids:
+        return {}
+    rows = session.exec(select(TaxHeader.id, TaxHeader.taxrate).where(TaxHeader.id.in_(ids))).all()
+    return {r[0]: r[1] or 0.0 for r in rows}
+
+
+def compute_line_columns(
+    qty: List[float],
+    rate: List[float],
+    disctype: List[Optional[str]],
+    discval: List[Optional[float]],
+    taxrate: List[float],
+    interstate: List[bool],
+) -> Dict[str, List[float]]:
+    amount = [_r2((q or 0) * (r or 0)) for q, r in zip(qty, rate)]
+    discount = [
+        _r2(a * (v or 0) / 100) if is_percent_discount(t) else _r2(v or 0)
+        for a, t, v in zip(amount, disctype, discval)
+    ]
+    after = [_r2(a - d) for a, d in zip(amount, discount)]
+    igstper = [t if i else 0.0 for t, i in zip(taxrate, interstate)]
+    halfper = [0.0 if i else t / 2 for t, i in zip(taxrate, interstate)]
+    igst = [_r2(a * p / 100) for a, p in zip(after, igstper)]
+    halftax = [_r2(a * p / 100) for a, p in zip(after, halfper)]
+    tax = [_r2(2 * h + g) for h, g in zip(halftax, igst)]
+    net = [_r2(a + t) for a, t in zip(after, tax)]
+    return {
+        "invoiceamount": amount,
+        "discount": discount,
+        "afterdiscountamount": after,
+        "taxrate": list(taxrate),
+        "cgstper": halfper,
+        "sgstper": list(halfper),
+        "igstper": igstper,
+        "gcgstamount": halftax,
+        "gsgstamount": list(halftax),
+        "gigstamount": igst,
+        "taxamount": tax,
+        "netamount": net,
+    }
+
+
+def compute_header_totals(
+    grossamount: float,
+    discountamount: float,
+    cgstamount: float,
+    sgstamount: float,
+    igstamount: float,
+    add_othercharges: float = 0.0,
+    ded_othercharges: float = 0.0,
+) -> Dict[str, float]:
+    total = (
+        grossamount - discountamount + cgstamount + sgstamount + igstamount
+        + (add_othercharges or 0) - (ded_othercharges or 0)
+    )
+    total = _r2(total)
+    totnetamount = math.floor(total + 0.5)  # nearest rupee
+    return {
+        "grossamount": _r2(grossamount),
+        "discountamount": _r2(discountamount),
+        "cgstamount": _r2(cgstamount),
+        "sgstamount": _r2(sgstamount),
+        "igstamount": _r2(igstamount),
+        "roundedoff": _r2(totnetamount - total),
+        "totnetamount": float(totnetamount),
+    }
+
+
+def calculate_invoices(invoices: list, taxrates: Optional[Dict[int, float]] = None) -> list:
+    """Recompute line amounts and header totals of invoices in place.
+
+    Works on PostInvoiceHeader / UpdateInvoiceHeader style objects (header
+    attributes plus an `invdetails` list). The tax rate comes from the line's
+    tax header when it is in `taxrates`, otherwise the line's own taxrate.
+    """
+    taxrates = taxrates or {}
+    lines, owner, interstate = [], [], []
+    for pos, inv in enumerate(invoices):
+        inter = is_interstate(inv.supplytype)
+        lines.extend(inv.invdetails)
+        owner.extend([pos] * len(inv.invdetails))
+        interstate.extend([inter] * len(inv.invdetails))
+
+    cols = compute_line_columns(
+        [d.invoiceqty for d in lines],
+        [d.invoicerate for d in lines],
+        [d.discounttype for d in lines],
+        [d.discount_amt_per for d in lines],
+        [taxrates.get(d.taxheaderid, d.taxrate or 0.0) for d in lines],
+        interstate,
+    )
+
+    # Write back without per-attribute validation, but still mark the fields as
+    # set so model_dump(exclude_unset=True) includes them
+    for d, values in zip(lines, zip(*(cols[f] for f in LINE_FIELDS))):
+        d.__dict__.update(zip(LINE_FIELDS, values))
+        d.__pydantic_fields_set__.update(LINE_FIELDS)
+
+    sums = [[0.0] * 5 for _ in invoices]
+    for pos, gross, disc, cgst, sgst, igst in zip(
+        owner, cols["invoiceamount"], cols["discount"],
+        cols["gcgstamount"], cols["gsgstamount"], cols["gigstamount"],
+    ):
+        s = sums[pos]
+        s[0] += gross
+        s[1] += disc
+        s[2] += cgst
+        s[3] += sgst
+        s[4] += igst
+
+    for inv, s in zip(invoices, sums):
+        totals = compute_header_totals(*s, inv.add_othercharges or 0, inv.ded_othercharges or 0)
+        for field, value in totals.items():
+            setattr(inv, field, value)
+    return invoices
+
+
+def calculate_invoice(session: Session, invoice):
+    return calculate_invoices(
+        [invoice], load_tax_rates(session, (d.taxheaderid for d in invoice.invdetails))
+    )[0]
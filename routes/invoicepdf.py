@@ -0,0 +1,570 @@
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
+from fastapi.responses import FileResponse
+from sqlmodel import Session, select, SQLModel, Field, Column
+from sqlalchemy import update, or_
+from sqlalchemy.dialects.postgresql import ARRAY, INTEGER
+from pydantic import BaseModel
+from .db import engine, get_session
+from typing import Dict, List, Optional
+from datetime import datetime, date, timedelta
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from routes.company import Company
+from routes.currecny import Currency
+from routes.invoice import (
+    InvoiceHeader, InvoiceDetailView, InvoiceTaxSummary, CustomerView,
+)
+import logging
+import os
+import re
+import shutil
+import tempfile
+import zlib
+
+
+router = APIRouter(tags=["Invoice"])
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# ---------------------------------------------------------------------------
+# Precompiled template
+#
+# Page geometry, column layout and every fixed PDF object (catalog, fonts) are
+# built once at import. Rendering an invoice only formats its text into content
+# streams and patches the page list and xref offsets.
+# ---------------------------------------------------------------------------
+
+PAGE_W, PAGE_H = 595, 842  # A4 in points
+MARGIN = 36
+ROW_H = 14
+BODY_TOP = 560             # first table row on page 1
+BODY_TOP_CONT = 760        # first table row on continuation pages
+BODY_BOTTOM = 200          # keep room for the tax footer / totals on the last page
+
+# (title, x, align, width in characters)
+COLUMNS = [
+    ("#", MARGIN, "l", 4),
+    ("Item", MARGIN + 22, "l", 30),
+    ("UOM", MARGIN + 200, "l", 6),
+    ("Qty", MARGIN + 275, "r", 10),
+    ("Rate", MARGIN + 335, "r", 12),
+    ("Amount", MARGIN + 400, "r", 12),
+    ("Tax", MARGIN + 450, "r", 8),
+    ("Net", PAGE_W - MARGIN, "r", 12),
+]
+
+_FIXED_OBJECTS = {
+    1: b"<< /Type /Catalog /Pages 2 0 R >>",
+    3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    4: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>",
+}
+_PAGE_TEMPLATE = (
+    "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+    "/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents %%d 0 R >>" % (PAGE_W, PAGE_H)
+)
+_HEADER = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+
+# Helvetica average glyph width (per 1pt font size) for right alignment
+_AVG_CHAR_W = 0.5
+
+
+def _pdf_text(value) -> bytes:
+    text = "" if value is None else str(value)
+    raw = text.encode("cp1252", errors="replace")
+    return raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def _fmt_amount(value) -> str:
+    return f"{(value or 0):,.2f}"
+
+
+def _fmt_date(value) -> str:
+    return value.strftime("%d/%m/%Y") if isinstance(value, (date, datetime)) else ""
+
+
+class _Canvas:
+    def __init__(self):
+        self.ops: List[bytes] = []
+
+    def text(self, x, y, value, size=9, bold=False, align="l"):
+        data = _pdf_text(value)
+        if align == "r":
+            x -= len(data) * size * _AVG_CHAR_W
+        self.ops.append(
+            b"BT /%s %d Tf %.1f %.1f Td (%s) Tj ET"
+            % (b"F2" if bold else b"F1", size, x, y, data)
+        )
+
+    def line(self, x1, y1, x2, y2):
+        self.ops.append(b"%.1f %.1f m %.1f %.1f l S" % (x1, y1, x2, y2))
+
+    def stream(self) -> bytes:
+        return zlib.compress(b"\n".join(self.ops))
+
+
+def _draw_table_header(c: _Canvas, y: float):
+    for title, x, align, _ in COLUMNS:
+        c.text(x, y, title, bold=True, align=align)
+    c.line(MARGIN, y - 4, PAGE_W - MARGIN, y - 4)
+
+
+def _draw_first_page_header(c: _Canvas, hdr: dict):
+    top = PAGE_H - MARGIN
+    c.text(MARGIN, top - 10, hdr.get("companyname"), size=14, bold=True)
+    y = top - 26
+    for value in (hdr.get("adress"), hdr.get("phone"), hdr.get("emailid")):
+        if value:
+            c.text(MARGIN, y, value)
+            y -= 12
+    if hdr.get("gstno"):
+        c.text(MARGIN, y, f"GSTIN: {hdr['gstno']}")
+
+    c.text(PAGE_W - MARGIN, top - 10, "TAX INVOICE", size=14, bold=True, align="r")
+    c.text(PAGE_W - MARGIN, top - 28, f"Invoice No: {hdr.get('invoiceno') or ''}", align="r")
+    c.text(PAGE_W - MARGIN, top - 40, f"Date: {_fmt_date(hdr.get('invoicedate'))}", align="r")
+    if hdr.get("referenceno"):
+        c.text(PAGE_W - MARGIN, top - 52,
+               f"Ref: {hdr['referenceno']} {_fmt_date(hdr.get('referencedate'))}", align="r")
+
+    c.line(MARGIN, top - 96, PAGE_W - MARGIN, top - 96)
+    y = top - 112
+    c.text(MARGIN, y, "Bill To", bold=True)
+    c.text(PAGE_W / 2, y, "Ship To", bold=True)
+    bill = [hdr.get("customername"), hdr.get("address1"), hdr.get("address2"),
+            " ".join(filter(None, [hdr.get("cityname"), hdr.get("pincode")])),
+            " ".join(filter(None, [hdr.get("statename"), hdr.get("countryname")])),
+            f"GSTIN: {hdr['gstin']}" if hdr.get("gstin") else None]
+    ship = [hdr.get("customername"), hdr.get("shipping_address1"), hdr.get("shipping_address2"),
+            " ".join(filter(None, [hdr.get("shipping_cityname"), hdr.get("shipping_pincode")])),
+            " ".join(filter(None, [hdr.get("shipping_statename"), hdr.get("shipping_countryname")])),
+            f"Place of supply: {hdr['placeof_supply']}" if hdr.get("placeof_supply") else None]
+    yb = y - 14
+    for value in filter(None, bill):
+        c.text(MARGIN, yb, value)
+        yb -= 12
+    ys = y - 14
+    for value in filter(None, ship):
+        c.text(PAGE_W / 2, ys, value)
+        ys -= 12
+
+
+def _draw_totals(c: _Canvas, data: dict, y: float):
+    hdr = data["header"]
+    c.line(MARGIN, y, PAGE_W - MARGIN, y)
+    y -= 16
+    c.text(MARGIN, y, "Tax Summary", bold=True)
+    ys = y - 14
+    for slab in data["footer"]:
+        c.text(MARGIN, ys, slab["taxslabname"])
+        c.text(MARGIN + 200, ys, _fmt_amount(slab["footeramt"]), align="r")
+        ys -= 12
+
+    currency = hdr.get("currencycode") or ""
+    rows = [
+        ("Gross Amount", hdr.get("grossamount")),
+        ("Discount", hdr.get("discountamount")),
+        ("CGST", hdr.get("cgstamount")),
+        ("SGST", hdr.get("sgstamount")),
+        ("IGST", hdr.get("igstamount")),
+        ("Other Charges (+)", hdr.get("add_othercharges")),
+        ("Other Charges (-)", hdr.get("ded_othercharges")),
+        ("Rounded Off", hdr.get("roundedoff")),
+    ]
+    yt = y
+    for label, value in rows:
+        if value:
+            c.text(PAGE_W - MARGIN - 150, yt, label)
+            c.text(PAGE_W - MARGIN, yt, _fmt_amount(value), align="r")
+            yt -= 12
+    yt -= 4
+    c.text(PAGE_W - MARGIN - 150, yt, f"Net Amount {currency}".strip(), bold=True)
+    c.text(PAGE_W - MARGIN, yt, _fmt_amount(hdr.get("totnetamount")), bold=True, align="r")
+    if hdr.get("remarks"):
+        c.text(MARGIN, min(ys, yt) - 20, f"Remarks: {hdr['remarks']}")
+
+
+def render_invoice_pdf(data: dict) -> bytes:
+    """Render one invoice (as returned by load_invoice_print_data) to PDF bytes.
+
+    Pure function of its input so it can run in worker processes.
+    """
+    pages: List[_Canvas] = []
+    c = _Canvas()
+    _draw_first_page_header(c, data["header"])
+    y = BODY_TOP
+    _draw_table_header(c, y)
+    y -= ROW_H + 2
+
+    for line in data["lines"]:
+        if y < BODY_BOTTOM:
+            pages.append(c)
+            c = _Canvas()
+            y = BODY_TOP_CONT
+            _draw_table_header(c, y)
+            y -= ROW_H + 2
+        values = [
+            line.get("rowno"),
+            (line.get("productname") or "")[:34],
+            line.get("uomcode"),
+            f"{(line.get('invoiceqty') or 0):,.3f}",
+            _fmt_amount(line.get("invoicerate")),
+            _fmt_amount(line.get("afterdiscountamount") or line.get("invoiceamount")),
+            _fmt_amount(line.get("taxamount")),
+            _fmt_amount(line.get("netamount")),
+        ]
+        for (_, x, align, _), value in zip(COLUMNS, values):
+            c.text(x, y, value, align=align)
+        y -= ROW_H
+
+    _draw_totals(c, data, y - 4)
+    pages.append(c)
+
+    # Assemble: fixed objects 1, 3, 4; pages object 2; then page/content pairs
+    objects: Dict[int, bytes] = dict(_FIXED_OBJECTS)
+    page_ids = []
+    next_id = 5
+    for page_no, canvas in enumerate(pages, start=1):
+        canvas.text(PAGE_W - MARGIN, MARGIN / 2, f"Page {page_no} of {len(pages)}", size=8, align="r")
+        stream = canvas.stream()
+        page_id, content_id = next_id, next_id + 1
+        next_id += 2
+        objects[page_id] = (_PAGE_TEMPLATE % content_id).encode()
+        objects[content_id] = (
+            b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream"
+        )
+        page_ids.append(page_id)
+    objects[2] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % i for i in page_ids), len(page_ids)
+    )
+
+    out = bytearray(_HEADER)
+    offsets = {}
+    for obj_id in sorted(objects):
+        offsets[obj_id] = len(out)
+        out += b"%d 0 obj\n" % obj_id + objects[obj_id] + b"\nendobj\n"
+    xref_at = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for obj_id in sorted(objects):
+        out += b"%010d 00000 n \n" % offsets[obj_id]
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_at)
+    return bytes(out)
+
+
+# ---------------------------------------------------------------------------
+# Data
+# ---------------------------------------------------------------------------
+
+def load_invoice_print_data(session: Session, invoice_ids: List[int]) -> Dict[int, dict]:
+    """Header, lines and tax footer of many invoices with three set-based queries."""
+    if not invoice_ids:
+        return {}
+    inv, comp, cust, cur = InvoiceHeader, Company, CustomerView, Currency
+
+    header_rows = session.exec(
+        select(
+            inv.id, inv.invoiceno, inv.invoicedate, inv.referenceno, inv.referencedate,
+            inv.remarks, inv.companyno, inv.modifiedon,
+            inv.grossamount, inv.discountamount, inv.cgstamount, inv.sgstamount, inv.igstamount,
+            inv.add_othercharges, inv.ded_othercharges, inv.roundedoff, inv.totnetamount,
+            comp.companyname, comp.adress, comp.phone, comp.emailid, comp.gstno,
+            cust.customername, cust.address1, cust.address2, cust.cityname, cust.statename,
+            cust.countryname, cust.pincode, cust.shipping_address1, cust.shipping_address2,
+            cust.shipping_cityname, cust.shipping_statename, cust.shipping_countryname,
+            cust.shipping_pincode, cust.gstin, cust.placeof_supply,
+            cur.currencycode,
+        )
+        .select_from(inv)
+        .join(comp, comp.id == inv.companyid)
+        .join(cust, cust.id == inv.customerid, isouter=True)
+        .join(cur, cur.id == inv.currencyid, isouter=True)
+        .where(inv.id.in_(invoice_ids))
+    ).all()
+    data = {
+        r.id: {"header": dict(r._mapping), "lines": [], "footer": []}
+        for r in header_rows
+    }
+
+    d = InvoiceDetailView
+    for r in session.exec(
+        select(
+            d.invoice_headerid, d.rowno, d.productname, d.uomcode, d.invoiceqty, d.invoicerate,
+            d.invoiceamount, d.afterdiscountamount, d.taxamount, d.netamount,
+        )
+        .where(d.invoice_headerid.in_(invoice_ids))
+        .order_by(d.invoice_headerid, d.rowno)
+    ).all():
+        if r.invoice_headerid in data:
+            data[r.invoice_headerid]["lines"].append(dict(r._mapping))
+
+    t = InvoiceTaxSummary
+    for r in session.exec(
+        select(t.invoiceid, t.taxslabname, t.taxamount)
+        .where(t.invoiceid.in_(invoice_ids), t.taxamount > 0)
+        .order_by(t.invoiceid, t.taxslabname)
+    ).all():
+        if r.invoiceid in data:
+            data[r.invoiceid]["footer"].append({"taxslabname": r.taxslabname, "footeramt": r.taxamount})
+
+    return data
+
+
+# ---------------------------------------------------------------------------
+# Rendered-document cache
+# ---------------------------------------------------------------------------
+
+def _safe_name(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", value or "")
+
+
+def pdf_cache_dir(companyno: str) -> Path:
+    return BASE_DIR / "uploads" / _safe_name(companyno) / "invoice" / "pdfcache"
+
+
+def pdf_cache_path(companyno: str, invoiceid: int, modifiedon: datetime) -> Path:
+    # modifiedon is part of the key, so any saved change makes a new entry
+    return pdf_cache_dir(companyno) / f"{invoiceid}_{modifiedon:%Y%m%d%H%M%S%f}.pdf"
+
+
+def write_cached_pdf(path: Path, pdf: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique temp file per write: threads of one worker may render the same invoice
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.stem + ".", suffix=".tmp", delete=False) as tmp:
+        tmp.write(pdf)
+    os.replace(tmp.name, path)
+    # drop older renders of the same invoice; the fixed-width modifiedon key sorts
+    # as text, and a newer render that finished first must survive a late older one
+    prefix, key = path.stem.split("_", 1)
+    for old in path.parent.glob(f"{prefix}_*.pdf"):
+        if old.stem.split("_", 1)[1] < key:
+            old.unlink(missing_ok=True)
+
+
+def get_invoice_pdf_path(session: Session, invoiceid: int) -> Path:
+    """Cached PDF for an invoice, rendering it on a cache miss."""
+    key = session.exec(
+        select(InvoiceHeader.companyno, InvoiceHeader.modifiedon, InvoiceHeader.invoiceno)
+        .where(InvoiceHeader.id == invoiceid)
+    ).first()
+    if not key:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+
+    path = pdf_cache_path(key.companyno, invoiceid, key.modifiedon)
+    if not path.exists():
+        data = load_invoice_print_data(session, [invoiceid])[invoiceid]
+        write_cached_pdf(path, render_invoice_pdf(data))
+    return path
+
+
+@router.get("/invoice/{invoiceid}/pdf")
+def get_invoice_pdf(invoiceid: int, session: Session = Depends(get_session)):
+    path = get_invoice_pdf_path(session, invoiceid)
+    invoiceno = session.exec(
+        select(InvoiceHeader.invoiceno).where(InvoiceHeader.id == invoiceid)
+    ).first()
+    filename = f"{_safe_name(invoiceno)}.pdf"
+    return FileResponse(
+        path=path,
+        media_type="application/pdf",
+        filename=filename,
+        headers={"Content-Disposition": f'inline; filename="{filename}"'},
+    )
+
+
+# ---------------------------------------------------------------------------
+# Batch rendering
+#
+# A job renders every invoice of a date range (or an explicit id list) into
+# uploads/{companyno}/invoice/batch_{jobid}, optionally zipped at the end.
+# Print data is fetched PDF_BATCH_CHUNK invoices at a time and rendered across a
+# process pool; each file is written atomically, so after a crash the job can be
+# resumed and only the missing files are produced.
+# ---------------------------------------------------------------------------
+
+PDF_BATCH_CHUNK = 200
+PDF_BATCH_WORKERS = int(os.getenv("PROBILL_PDF_WORKERS", "0")) or os.cpu_count() or 1
+# A queued/running job whose progress has not moved for this long was left by a crash
+PDF_JOB_STALE = timedelta(minutes=int(os.getenv("PROBILL_PDF_JOB_STALE_MINUTES", "10")))
+
+
+class InvoicePdfJob(SQLModel, table=True):
+    __tablename__ = "invoice_pdf_job"
+    __table_args__ = {"extend_existing": True}
+    id: int | None = Field(default=None, primary_key=True)
+    createdby: str = Field(nullable=False)
+    createdon: datetime = Field(default_factory=datetime.now)
+    modifiedon: datetime = Field(default_factory=datetime.now, sa_column_kwargs={"onupdate": datetime.now})
+    companyid: int = Field(foreign_key="company.id", nullable=False, index=True)
+    companyno: str
+    fromdate: Optional[date] = None
+    todate: Optional[date] = None
+    invoiceids: Optional[List[int]] = Field(default=None, sa_column=Column(ARRAY(INTEGER)))
+    makezip: bool = False
+    status: str = Field(default="queued")  # queued / running / completed / failed
+    total: int = 0
+    done: int = 0
+    failed: int = 0
+    outputdir: Optional[str] = None
+    zipfile: Optional[str] = None
+    error: Optional[str] = None
+
+
+class InvoicePdfJobRequest(BaseModel):
+    companyid: int
+    createdby: str
+    fromdate: Optional[date] = None
+    todate: Optional[date] = None
+    invoiceids: Optional[List[int]] = None
+    makezip: bool = False
+
+
+def _render_to_file(item):
+    # Runs in a worker process: render and write atomically, report the outcome
+    invoiceid, path, data = item
+    try:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(render_invoice_pdf(data))
+        os.replace(tmp, path)
+        return invoiceid, None
+    except Exception as exc:
+        return invoiceid, str(exc)
+
+
+def _job_output_dir(job: InvoicePdfJob) -> Path:
+    return BASE_DIR / "uploads" / _safe_name(job.companyno) / "invoice" / f"batch_{job.id}"
+
+
+def _update_job(jobid: int, **values):
+    with Session(engine) as session:
+        job = session.get(InvoicePdfJob, jobid)
+        for key, value in values.items():
+            setattr(job, key, value)
+        session.add(job)
+        session.commit()
+
+
+def run_invoice_pdf_job(jobid: int):
+    """Render all missing files of a job, recording progress after every chunk."""
+    with Session(engine) as session:
+        job = session.get(InvoicePdfJob, jobid)
+        if not job:
+            return
+        outdir = _job_output_dir(job)
+        outdir.mkdir(parents=True, exist_ok=True)
+
+        # ✅ Step 1: resolve the invoice set in one query
+        query = select(InvoiceHeader.id, InvoiceHeader.invoiceno).where(
+            InvoiceHeader.companyid == job.companyid
+        )
+        if job.invoiceids:
+            query = query.where(InvoiceHeader.id.in_(job.invoiceids))
+        else:
+            if job.fromdate:
+                query = query.where(InvoiceHeader.invoicedate >= job.fromdate)
+            if job.todate:
+                query = query.where(InvoiceHeader.invoicedate <= job.todate)
+        targets = {
+            r.id: outdir / f"{_safe_name(r.invoiceno) or 'invoice'}_{r.id}.pdf"
+            for r in session.exec(query.order_by(InvoiceHeader.invoicedate, InvoiceHeader.id)).all()
+        }
+
+    # ✅ Step 2: skip what an earlier (interrupted) run already wrote
+    pending = [i for i, path in targets.items() if not path.exists()]
+    done = len(targets) - len(pending)
+    failed = 0
+    _update_job(jobid, status="running", total=len(targets), done=done, failed=0,
+                outputdir=str(outdir), error=None)
+
+    try:
+        # ✅ Step 3: bulk-load a chunk, fan it out to the pool
+        with ProcessPoolExecutor(max_workers=PDF_BATCH_WORKERS) as pool, Session(engine) as session:
+            for start in range(0, len(pending), PDF_BATCH_CHUNK):
+                chunk = pending[start:start + PDF_BATCH_CHUNK]
+                data = load_invoice_print_data(session, chunk)
+                items = [(i, str(targets[i]), data[i]) for i in chunk if i in data]
+                for invoiceid, err in pool.map(_render_to_file, items, chunksize=8):
+                    if err:
+                        failed += 1
+                        logger.warning("Invoice %s PDF failed: %s", invoiceid, err)
+                    else:
+                        done += 1
+                _update_job(jobid, done=done, failed=failed)
+
+        # ✅ Step 4: optional archive of the whole directory
+        zippath = None
+        with Session(engine) as session:
+            makezip = session.get(InvoicePdfJob, jobid).makezip
+        if makezip:
+            zippath = shutil.make_archive(str(outdir), "zip", root_dir=outdir)
+        _update_job(jobid, status="completed" if not failed else "failed",
+                    zipfile=zippath, error=f"{failed} invoice(s) failed" if failed else None)
+    except Exception as exc:
+        logger.exception("Invoice PDF job %s failed", jobid)
+        _update_job(jobid, status="failed", error=str(exc))
+
+
+@router.post("/invoice/pdfbatch", response_model=InvoicePdfJob)
+def create_invoice_pdf_job(
+    payload: InvoicePdfJobRequest,
+    background_tasks: BackgroundTasks,
+    session: Session = Depends(get_session),
+):
+    if not payload.invoiceids and not (payload.fromdate and payload.todate):
+        raise HTTPException(status_code=400, detail="Give invoiceids or fromdate and todate")
+    company = session.get(Company, payload.companyid)
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+
+    job = InvoicePdfJob(**payload.model_dump(), companyno=company.companyno)
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    background_tasks.add_task(run_invoice_pdf_job, job.id)
+    return job
+
+
+@router.get("/invoice/pdfbatch/{jobid}", response_model=InvoicePdfJob)
+def get_invoice_pdf_job(jobid: int, session: Session = Depends(get_session)):
+    job = session.get(InvoicePdfJob, jobid)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/invoice/pdfbatch/{jobid}/resume", response_model=InvoicePdfJob)
+def resume_invoice_pdf_job(
+    jobid: int,
+    background_tasks: BackgroundTasks,
+    session: Session = Depends(get_session),
+):
+    job = session.get(InvoicePdfJob, jobid)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # Files already written are skipped, so this also repairs a completed job
+    # whose output was partly removed; a job left "running" by a crash restarts here.
+    # Claimed with a conditional UPDATE, so a live run is never started twice.
+    now = datetime.now()
+    claimed = session.execute(
+        update(InvoicePdfJob)
+        .where(
+            InvoicePdfJob.id == jobid,
+            or_(InvoicePdfJob.status.not_in(("queued", "running")), InvoicePdfJob.modifiedon < now - PDF_JOB_STALE),
+        )
+        .values(status="queued", modifiedon=now)
+    ).rowcount
+    session.commit()
+    if not claimed:
+        raise HTTPException(status_code=409, detail="Job is already running")
+    session.refresh(job)
+    background_tasks.add_task(run_invoice_pdf_job, job.id)
+    return job
+
+
+@router.get("/invoice/pdfbatch/{jobid}/download")
+def download_invoice_pdf_job(jobid: int, session: Session = Depends(get_session)):
+    job = session.get(InvoicePdfJob, jobid)
+    if not job or not job.zipfile or not os.path.exists(job.zipfile):
+        raise HTTPException(status_code=404, detail="Archive not available")
+    return FileResponse(path=job.zipfile, media_type="application/zip",
+                        filename=f"invoices_{job.companyno}_{job.id}.zip")
@@ -0,0 +1,386 @@
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
+from sqlmodel import Session, select, SQLModel, Field
+from sqlalchemy import UniqueConstraint, Index, text
+from sqlalchemy.dialects.postgresql import insert
+from pydantic import BaseModel
+from .db import engine, get_session
+from typing import Dict, Iterator, List, Optional, Tuple
+from datetime import datetime, date
+import csv
+import io
+import json
+
+
+router = APIRouter(tags=["Customer"])
+
+# Customer ledger and balances.
+#
+# customer_ledger holds one row per live document (invoice debit, receipt credit);
+# customer_balance holds the running totals per customer. After a document write
+# the caller runs sync_customer_ledger() for the touched documents in the same
+# transaction: their ledger rows are replaced and only the difference between
+# old and new rows is added to the customer balances. Cancelled or deleted
+# documents simply have no ledger row.
+#
+# ledger_version counts the writes to a company's invoices and receipts. It is
+# bumped in the writing transaction and its row lock is held until commit, so a
+# reader that sees an unchanged version has seen no newer committed write (the
+# aging cache relies on this; a timestamp taken before commit could not).
+
+# Ledger rows of documents, read straight from the document tables. A receipt
+# credits what it settled on invoices (greceiptamount, TDS and commission
+# included) plus the cash it left on account (receiptamount not covered by the
+# lines' netreceiptamount), so balance is what the customer still owes after
+# all payments, allocated or not.
+LEDGER_SOURCES = {
+    "INV": """
+        SELECT h.companyid, h.customerid, 'INV' AS doctype, h.id AS docid, h.invoiceno AS docno,
+               h.invoicedate AS docdate, h.totnetamount AS debit, 0.0 AS credit
+        FROM invoice_header h
+        WHERE h.cancel = 'F' AND {where}
+    """,
+    "REC": """
+        SELECT h.companyid, h.customerid, 'REC' AS doctype, h.id AS docid, h.receiptno AS docno,
+               h.receiptdate AS docdate, 0.0 AS debit,
+               COALESCE(SUM(d.greceiptamount), 0)
+                 + GREATEST(COALESCE(h.receiptamount, 0) - COALESCE(SUM(d.netreceiptamount), 0), 0) AS credit
+        FROM receipts_header h
+        LEFT JOIN receipts_detail d ON d.receiptheaderid = h.id
+        WHERE h.cancel <> 'T' AND {where}
+        GROUP BY h.id
+    """,
+}
+LEDGER_COLUMNS = ["companyid", "customerid", "doctype", "docid", "docno", "docdate", "debit", "credit"]
+
+
+class CustomerLedger(SQLModel, table=True):
+    __tablename__ = "customer_ledger"
+    __table_args__ = (
+        UniqueConstraint("doctype", "docid", name="uq_customer_ledger_doc"),
+        # statement of account: a customer's documents in date order
+        Index("ix_customer_ledger_customer_date", "companyid", "customerid", "docdate", "id"),
+        {"extend_existing": True},
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    companyid: int = Field(nullable=False)
+    customerid: int = Field(nullable=False)
+    doctype: str = Field(nullable=False)  # INV / REC
+    docid: int = Field(nullable=False)
+    docno: str = Field(default="")
+    docdate: date
+    debit: float = Field(default=0.0)
+    credit: float = Field(default=0.0)
+    modifiedon: datetime = Field(default_factory=datetime.now)
+
+
+class CustomerBalance(SQLModel, table=True):
+    __tablename__ = "customer_balance"
+    __table_args__ = {"extend_existing": True}
+    companyid: int = Field(primary_key=True)
+    customerid: int = Field(primary_key=True)
+    debit: float = Field(default=0.0)
+    credit: float = Field(default=0.0)
+    balance: float = Field(default=0.0)  # debit - credit = outstanding, less on-account cash
+    modifiedon: datetime = Field(default_factory=datetime.now)
+
+
+class LedgerVersion(SQLModel, table=True):
+    __tablename__ = "ledger_version"
+    __table_args__ = {"extend_existing": True}
+    companyid: int = Field(primary_key=True)
+    version: int = Field(default=0)
+
+
+class CustomerBalanceRead(BaseModel):
+    companyid: int
+    customerid: int
+    customername: Optional[str] = None
+    debit: float
+    credit: float
+    balance: float
+    modifiedon: datetime
+
+
+def bump_ledger_version(session: Session, companyids):
+    """Record a write to the companies' invoices or receipts (in the caller's transaction)."""
+    companyids = sorted(set(companyids))
+    if not companyids:
+        return
+    table = LedgerVersion.__table__
+    stmt = insert(table).values([{"companyid": c, "version": 1} for c in companyids])
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.companyid], set_={"version": table.c.version + 1}
+    ))
+
+
+def ledger_version(session: Session, companyid: int) -> int:
+    version = session.exec(select(LedgerVersion.version).where(LedgerVersion.companyid == companyid)).first()
+    return version or 0
+
+
+def sync_customer_ledger(session: Session, doctype: str, docids: List[int]):
+    """Bring the ledger rows of some documents up to date and apply the balance deltas."""
+    docids = sorted(set(docids))
+    if not docids:
+        return
+    led = CustomerLedger.__table__
+    now = datetime.now()
+
+    # ✅ Step 1: current ledger rows (locked) and what they should be now
+    old = session.execute(
+        select(led.c.companyid, led.c.customerid, led.c.debit, led.c.credit)
+        .where(led.c.doctype == doctype, led.c.docid.in_(docids))
+        .with_for_update()
+    ).mappings().all()
+    new = session.execute(
+        text(LEDGER_SOURCES[doctype].format(where="h.id = ANY(:ids)")), {"ids": docids}
+    ).mappings().all()
+
+    deltas: Dict[Tuple[int, int], List[float]] = {}
+    for sign, rows in ((-1, old), (1, new)):
+        for r in rows:
+            d = deltas.setdefault((r["companyid"], r["customerid"]), [0.0, 0.0])
+            d[0] += sign * (r["debit"] or 0)
+            d[1] += sign * (r["credit"] or 0)
+
+    # ✅ Step 2: replace the documents' ledger rows
+    session.execute(led.delete().where(led.c.doctype == doctype, led.c.docid.in_(docids)))
+    if new:
+        session.execute(led.insert(), [{**dict(r), "modifiedon": now} for r in new])
+
+    # ✅ Step 3: add the deltas to the balances (sorted, to lock rows in a stable order).
+    # Zero deltas are written too, so modifiedon marks every write.
+    changes = [
+        {"companyid": c, "customerid": cu, "debit": dr, "credit": cr, "balance": dr - cr, "modifiedon": now}
+        for (c, cu), (dr, cr) in sorted(deltas.items())
+    ]
+    if changes:
+        bal = CustomerBalance.__table__
+        stmt = insert(bal).values(changes)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[bal.c.companyid, bal.c.customerid],
+            set_={
+                "debit": bal.c.debit + stmt.excluded.debit,
+                "credit": bal.c.credit + stmt.excluded.credit,
+                "balance": bal.c.balance + stmt.excluded.balance,
+                "modifiedon": stmt.excluded.modifiedon,
+            },
+        )
+        session.execute(stmt)
+        bump_ledger_version(session, [c for c, _ in deltas])
+
+
+def rebuild_customer_ledger(session: Session, companyid: int):
+    """Recreate a company's ledger and balances from the documents (set-based)."""
+    led, bal = CustomerLedger.__table__, CustomerBalance.__table__
+    session.execute(led.delete().where(led.c.companyid == companyid))
+    session.execute(bal.delete().where(bal.c.companyid == companyid))
+    cols = ", ".join(LEDGER_COLUMNS)
+    for source in LEDGER_SOURCES.values():
+        session.execute(
+            text(f"INSERT INTO customer_ledger ({cols}, modifiedon) "
+                 f"SELECT {cols}, now() FROM ({source.format(where='h.companyid = :companyid')}) src"),
+            {"companyid": companyid},
+        )
+    session.execute(
+        text("""
+            INSERT INTO customer_balance (companyid, customerid, debit, credit, balance, modifiedon)
+            SELECT companyid, customerid, SUM(debit), SUM(credit), SUM(debit) - SUM(credit), now()
+            FROM customer_ledger WHERE companyid = :companyid
+            GROUP BY companyid, customerid
+        """),
+        {"companyid": companyid},
+    )
+
+
+LEDGER_SYNC_CHUNK = 500
+
+# Documents whose ledger row is missing, stale, or left over from a removed document
+LEDGER_DRIFT_SQL = """
+    SELECT COALESCE(src.docid, l.docid) AS docid
+    FROM ({source}) src
+    FULL JOIN (SELECT * FROM customer_ledger WHERE doctype = :doctype) l ON l.docid = src.docid
+    WHERE l.id IS NULL OR src.docid IS NULL
+       OR l.customerid <> src.customerid OR l.docdate <> src.docdate
+       OR abs(l.debit - src.debit) > 0.005 OR abs(l.credit - src.credit) > 0.005
+"""
+
+# Balance rows that do not equal the sum of their ledger rows
+BALANCE_DRIFT_SQL = text("""
+    INSERT INTO customer_balance (companyid, customerid, debit, credit, balance, modifiedon)
+    SELECT companyid, customerid, SUM(debit), SUM(credit), SUM(debit) - SUM(credit), :now
+    FROM customer_ledger
+    GROUP BY companyid, customerid
+    ON CONFLICT (companyid, customerid) DO UPDATE
+    SET debit = excluded.debit, credit = excluded.credit, balance = excluded.balance,
+        modifiedon = excluded.modifiedon
+    WHERE abs(customer_balance.debit - excluded.debit) > 0.005
+       OR abs(customer_balance.credit - excluded.credit) > 0.005
+       OR abs(customer_balance.balance - excluded.balance) > 0.005
+""")
+
+
+def backfill_customer_ledger() -> int:
+    """Startup: bring the ledger and balances in step with invoices and receipts.
+
+    Fills the tables on first deploy, and repairs documents written outside the
+    API; on a database that is in step it only reads.
+    """
+    with Session(engine) as session:
+        synced = 0
+        for doctype, source in LEDGER_SOURCES.items():
+            ids = session.execute(
+                text(LEDGER_DRIFT_SQL.format(source=source.format(where="TRUE"))), {"doctype": doctype}
+            ).scalars().all()
+            for start in range(0, len(ids), LEDGER_SYNC_CHUNK):
+                sync_customer_ledger(session, doctype, list(ids[start:start + LEDGER_SYNC_CHUNK]))
+                session.commit()
+            synced += len(ids)
+        session.execute(BALANCE_DRIFT_SQL, {"now": datetime.now()})
+        session.commit()
+        return synced
+
+
+@router.get("/customer/balance/{companyid}", response_model=List[CustomerBalanceRead])
+def get_customer_balances(
+    companyid: int,
+    customerid: Optional[int] = None,
+    outstanding: bool = False,
+    session: Session = Depends(get_session),
+):
+    from routes.customer import CustomerHeader
+
+    b = CustomerBalance
+    statement = (
+        select(b, CustomerHeader.customername)
+        .join(CustomerHeader, CustomerHeader.id == b.customerid, isouter=True)
+        .where(b.companyid == companyid)
+        .order_by(b.balance.desc())
+    )
+    if customerid:
+        statement = statement.where(b.customerid == customerid)
+    if outstanding:
+        statement = statement.where(b.balance > 0)
+    return [
+        CustomerBalanceRead(**row.model_dump(), customername=name)
+        for row, name in session.exec(statement).all()
+    ]
+
+
+@router.post("/customer/balance/rebuild/{companyid}")
+def rebuild_customer_balances(companyid: int, session: Session = Depends(get_session)):
+    rebuild_customer_ledger(session, companyid)
+    session.commit()
+    count = len(session.exec(select(CustomerBalance.customerid).where(CustomerBalance.companyid == companyid)).all())
+    return {"detail": f"Ledger rebuilt for {count} customers"}
+
+
+# Statement of account
+#
+# Read from customer_ledger on ix_customer_ledger_customer_date: one aggregate for
+# the opening balance, then the period's documents with the running balance taken
+# by a window function. Rows are streamed from a server-side cursor, so a year of
+# a large distributor's documents never sits in memory on either side.
+
+STATEMENT_CHUNK = 1000
+
+STATEMENT_OPENING_SQL = text("""
+    SELECT COALESCE(SUM(debit - credit), 0)
+    FROM customer_ledger
+    WHERE companyid = :companyid AND customerid = :customerid AND docdate < :fromdate
+""")
+
+STATEMENT_SQL = text("""
+    SELECT docdate, doctype, docid, docno, debit, credit,
+           :opening + SUM(debit - credit) OVER (
+               ORDER BY docdate, doctype, id ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+           ) AS balance
+    FROM customer_ledger
+    WHERE companyid = :companyid AND customerid = :customerid
+      AND docdate >= :fromdate AND docdate <= :todate
+    ORDER BY docdate, doctype, id
+""")
+
+STATEMENT_FIELDS = ["docdate", "doctype", "docid", "docno", "debit", "credit", "balance"]
+
+
+def _statement_rows(companyid: int, customerid: int, fromdate: date, todate: date) -> Iterator[dict]:
+    # Runs after the request's session is closed, so it opens its own
+    params = {"companyid": companyid, "customerid": customerid, "fromdate": fromdate, "todate": todate}
+    with Session(engine) as session:
+        opening = float(session.execute(STATEMENT_OPENING_SQL, params).scalar_one())
+        balance = opening
+        yield {"docdate": fromdate.isoformat(), "doctype": "OPENING", "docid": None, "docno": "",
+               "debit": 0.0, "credit": 0.0, "balance": round(opening, 2)}
+        result = session.execute(
+            STATEMENT_SQL, {**params, "opening": opening},
+            execution_options={"stream_results": True, "max_row_buffer": STATEMENT_CHUNK},
+        )
+        for r in result:
+            balance = r.balance
+            yield {"docdate": r.docdate.isoformat(), "doctype": r.doctype, "docid": r.docid, "docno": r.docno,
+                   "debit": round(r.debit, 2), "credit": round(r.credit, 2), "balance": round(balance, 2)}
+        yield {"docdate": todate.isoformat(), "doctype": "CLOSING", "docid": None, "docno": "",
+               "debit": 0.0, "credit": 0.0, "balance": round(balance, 2)}
+
+
+def _chunked(lines: Iterator[str]) -> Iterator[str]:
+    # One write per STATEMENT_CHUNK rows rather than per row
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) >= STATEMENT_CHUNK:
+            yield "".join(buf)
+            buf = []
+    if buf:
+        yield "".join(buf)
+
+
+def _statement_csv(rows: Iterator[dict]) -> Iterator[str]:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=STATEMENT_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+
+@router.get("/customer/{customerid}/statement")
+def customer_statement(
+    customerid: int,
+    fromdate: Optional[date] = Query(default=None, alias="from"),
+    todate: Optional[date] = Query(default=None, alias="to"),
+    format: str = "ndjson",
+    session: Session = Depends(get_session),
+):
+    from routes.customer import CustomerHeader
+    from routes.docseries import get_financial_year
+
+    customer = session.get(CustomerHeader, customerid)
+    if not customer:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+
+    # ✅ Step 1: period defaults to the current financial year up to today
+    todate = todate or date.today()
+    if fromdate is None:
+        fy_start = int(get_financial_year(todate)[:4])
+        fromdate = date(fy_start, 4, 1)
+    if fromdate > todate:
+        raise HTTPException(status_code=400, detail="from must not be after to")
+
+    # ✅ Step 2: stream, one generator holding its own session
+    rows = _statement_rows(customer.companyid, customerid, fromdate, todate)
+    filename = f"statement_{customerid}_{fromdate:%Y%m%d}_{todate:%Y%m%d}"
+    if format == "csv":
+        return StreamingResponse(
+            _chunked(_statement_csv(rows)), media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.csv"'},
+        )
+    return StreamingResponse(
+        _chunked(json.dumps(row) + "\n" for row in rows), media_type="application/x-ndjson",
+    )
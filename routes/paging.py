@@ -0,0 +1,34 @@
+import base64
+import json
+from datetime import date, datetime
+from decimal import InvalidOperation
+from fastapi import HTTPException
+from typing import Any, List
+
+# Opaque keyset cursors: the sort-key values of the last row of a page,
+# JSON encoded and base64'd so clients just pass them back unchanged.
+
+
+def encode_cursor(*values: Any) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, (date, datetime)) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *types: type) -> List[Any]:
+    """Decode a cursor made by encode_cursor, converting each value to the given type."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError("cursor shape")
+        out = []
+        for value, typ in zip(values, types):
+            if typ is date:
+                out.append(date.fromisoformat(value))
+            elif typ is datetime:
+                out.append(datetime.fromisoformat(value))
+            else:
+                out.append(typ(value))
+        return out
+    except (ValueError, TypeError, InvalidOperation):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
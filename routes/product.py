@@ -147,10 +147,16 @@ def update_product(productid: int, product: ProductUpdate, session: Session = De
     db_product = session.get(ProductHeader, productid)
     if not db_product:
         raise HTTPException(status_code=404, detail="Product not found")
+    oldname = db_product.productname
     for key, value in product.model_dump(exclude_unset=True).items():
         setattr(db_product, key, value)
 
     session.add(db_product)
+    if db_product.productname != oldname:
+        # invoice search rows carry product names; same transaction
+        from routes.invoice import reindex_invoices_by_name
+        session.flush()
+        reindex_invoices_by_name(session, itemid=productid)
     session.commit()
     session.refresh(db_product)
     return db_product
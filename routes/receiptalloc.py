@@ -0,0 +1,221 @@
+from fastapi import APIRouter, HTTPException, Depends
+from sqlmodel import Session
+from sqlalchemy import insert, text
+from pydantic import BaseModel
+from .db import get_session
+from typing import List, Optional
+from datetime import date
+from routes.receipts import ReceiptsHeader, ReceiptsDetail, refresh_invoice_receipt_amounts
+from routes.docseries import next_document_no
+from routes.invoicecalc import round_amount
+from routes.ledger import sync_customer_ledger
+
+
+router = APIRouter(tags=["Receipts"])
+
+# FIFO allocation of a lump-sum payment.
+#
+# The settled amount (cash + TDS + commission) is spread over the customer's open
+# invoices oldest first. A running total over the outstanding balances is taken
+# in SQL with a window function, on the partial index ix_invoice_header_open, and
+# only the invoices the payment reaches come back to Python. TDS and commission
+# are then prorated over those lines by their share of the settled amount, so
+# a payment that is not fully allocated keeps its share of them unallocated.
+
+
+class ReceiptAllocationRequest(BaseModel):
+    companyid: int
+    customerid: int
+    receiptdate: date
+    amount: float                   # cash received
+    tdsamount: float = 0.0          # deducted by the customer
+    commisionamount: float = 0.0    # bank / agent charges
+    currencyid: Optional[int] = None  # only invoices in this currency
+
+
+class ReceiptAllocationApply(ReceiptAllocationRequest):
+    createdby: str
+    modifiedby: str
+    companyno: str
+    receipttype: str = "Receipt"
+    paymentmode: str
+    currencyid: int
+    exrate: float = 1.0
+    transactionno: Optional[str] = None
+    transactiondate: Optional[date] = None
+    chequeno: Optional[str] = None
+    cheqedate: Optional[date] = None
+    remarks: Optional[str] = None
+
+
+class ReceiptAllocationLine(BaseModel):
+    invoiceid: int
+    invoiceno: str
+    invoicedate: date
+    invoiceamount: float
+    outstanding: float
+    gcurrency: int
+    gexrate: float
+    greceiptamount: float
+    tdsamount: float
+    commisionamount: float
+    netreceiptamount: float
+
+
+class ReceiptAllocationResponse(BaseModel):
+    settled: float
+    allocated: float
+    unallocated: float
+    allocations: List[ReceiptAllocationLine] = []
+    receiptid: Optional[int] = None
+    receiptno: Optional[str] = None
+
+
+FIFO_ALLOCATION_SQL = text("""
+    SELECT id, invoiceno, invoicedate, totnetamount, currencyid, exrate, balance,
+           LEAST(balance, :settle - (running - balance)) AS allocated
+    FROM (
+        SELECT id, invoiceno, invoicedate, totnetamount, currencyid, exrate,
+               totnetamount - COALESCE(receiptamount, 0) AS balance,
+               SUM(totnetamount - COALESCE(receiptamount, 0))
+                   OVER (ORDER BY invoicedate, id) AS running
+        FROM invoice_header
+        WHERE companyid = :companyid
+          AND customerid = :customerid
+          AND cancel = 'F'
+          AND totnetamount > COALESCE(receiptamount, 0)
+          AND invoicedate <= :receiptdate
+          AND (CAST(:currencyid AS integer) IS NULL OR currencyid = :currencyid)
+    ) open_invoices
+    WHERE running - balance < :settle
+    ORDER BY invoicedate, id
+""")
+
+
+def _prorate(total: float, weights: List[float]) -> List[float]:
+    # Split `total` by weight to paise; the rounding remainder goes to the last line
+    if not weights or not total:
+        return [0.0] * len(weights)
+    base = sum(weights)
+    shares = [round_amount(total * w / base) for w in weights]
+    shares[-1] = round_amount(total - sum(shares[:-1]))
+    return shares
+
+
+def allocate_fifo(session: Session, req: ReceiptAllocationRequest) -> ReceiptAllocationResponse:
+    settle = round_amount(req.amount + req.tdsamount + req.commisionamount)
+    if settle <= 0:
+        raise HTTPException(status_code=400, detail="Nothing to allocate")
+
+    rows = session.execute(FIFO_ALLOCATION_SQL, {
+        "settle": settle,
+        "companyid": req.companyid,
+        "customerid": req.customerid,
+        "receiptdate": req.receiptdate,
+        "currencyid": req.currencyid,
+    }).all()
+
+    gross = [round_amount(r.allocated) for r in rows]
+    allocated = round_amount(sum(gross))
+    # only the allocated share of TDS and commission belongs to these lines;
+    # the rest goes with the unallocated remainder
+    share = allocated / settle
+    tds = _prorate(round_amount(req.tdsamount * share), gross)
+    commission = _prorate(round_amount(req.commisionamount * share), gross)
+    lines = [
+        ReceiptAllocationLine(
+            invoiceid=r.id,
+            invoiceno=r.invoiceno,
+            invoicedate=r.invoicedate,
+            invoiceamount=r.totnetamount,
+            outstanding=round_amount(r.balance),
+            gcurrency=r.currencyid,
+            gexrate=r.exrate,
+            greceiptamount=g,
+            tdsamount=t,
+            commisionamount=c,
+            netreceiptamount=round_amount(g - t - c),
+        )
+        for r, g, t, c in zip(rows, gross, tds, commission)
+    ]
+    return ReceiptAllocationResponse(
+        settled=settle, allocated=allocated, unallocated=round_amount(settle - allocated), allocations=lines
+    )
+
+
+@router.post("/receipts/allocate/propose", response_model=ReceiptAllocationResponse)
+def propose_allocation(payload: ReceiptAllocationRequest, session: Session = Depends(get_session)):
+    return allocate_fifo(session, payload)
+
+
+@router.post("/receipts/allocate/apply", response_model=ReceiptAllocationResponse)
+def apply_allocation(payload: ReceiptAllocationApply, session: Session = Depends(get_session)):
+    try:
+        # ✅ Step 1: one allocation at a time per customer, so two payments
+        # cannot both settle the same outstanding balance
+        session.execute(
+            text("SELECT pg_advisory_xact_lock(:companyid, :customerid)"),
+            {"companyid": payload.companyid, "customerid": payload.customerid},
+        )
+
+        # ✅ Step 2: FIFO allocation
+        result = allocate_fifo(session, payload)
+        if not result.allocations:
+            raise HTTPException(status_code=400, detail="Customer has no open invoices")
+
+        # ✅ Step 3: receipt header, then all lines in one INSERT
+        db_receipt = ReceiptsHeader(
+            createdby=payload.createdby,
+            modifiedby=payload.modifiedby,
+            companyid=payload.companyid,
+            companyno=payload.companyno,
+            receiptno=next_document_no(session, payload.companyid, "REC", payload.receiptdate),
+            receiptdate=payload.receiptdate,
+            receipttype=payload.receipttype,
+            customerid=payload.customerid,
+            receiptamount=payload.amount,
+            paymentmode=payload.paymentmode,
+            currencyid=payload.currencyid,
+            exrate=payload.exrate,
+            transactionno=payload.transactionno,
+            transactiondate=payload.transactiondate,
+            chequeno=payload.chequeno,
+            cheqedate=payload.cheqedate,
+            remarks=payload.remarks,
+            totalreceiptamount=result.allocated,
+        )
+        session.add(db_receipt)
+        session.flush()
+
+        session.execute(insert(ReceiptsDetail), [
+            {
+                "receiptheaderid": db_receipt.id,
+                "rowno": rowno,
+                "invoiceno": line.invoiceid,
+                "invoicedate": line.invoicedate,
+                "invoiceamount": line.invoiceamount,
+                "gcurrency": line.gcurrency,
+                "gexrate": line.gexrate,
+                "greceiptamount": line.greceiptamount,
+                "commisionamount": line.commisionamount,
+                "tdsamount": line.tdsamount,
+                "netreceiptamount": line.netreceiptamount,
+            }
+            for rowno, line in enumerate(result.allocations, start=1)
+        ])
+
+        # ✅ Step 4: invoice receipt amounts and customer ledger, same transaction
+        refresh_invoice_receipt_amounts(session, [line.invoiceid for line in result.allocations])
+        sync_customer_ledger(session, "REC", [db_receipt.id])
+        session.commit()
+
+        result.receiptid = db_receipt.id
+        result.receiptno = db_receipt.receiptno
+        return result
+
+    except HTTPException:
+        session.rollback()
+        raise
+    except Exception as e:
+        session.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
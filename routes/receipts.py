@@ -1,6 +1,7 @@
-from fastapi import  FastAPI, APIRouter, HTTPException, Depends,Query
+from fastapi import  FastAPI, APIRouter, HTTPException, Depends,Query,Header,Response
 from sqlmodel import Session, select, SQLModel, Field ,delete ,func ,and_ 
-from sqlalchemy import  case,cast,Float,update
+from sqlalchemy import  case,cast,Float,update,Index,tuple_
+from sqlalchemy.orm import aliased
 from .db import engine, get_session 
 from pydantic import  validator, BaseModel ,EmailStr 
 from typing import List, Optional
@@ -11,13 +12,22 @@ from routes.userauth import get_current_user
 from routes.customer import CustomerHeader
 from routes.currecny  import Currency
 from routes.invoice import InvoiceHeader
+from routes.docseries import next_document_no
+from routes.idempotency import claim_idempotency_key, save_idempotent_response
+from routes.etag import make_etag, etag_matches, not_modified, set_etag
+from routes.paging import encode_cursor, decode_cursor
+from routes.ledger import sync_customer_ledger, bump_ledger_version
 
 
 router = APIRouter( tags=["Receipts"])
 
 class ReceiptsHeader(CommonFields, table=True):
     __tablename__ = "receipts_header"
-    __table_args__ = {"extend_existing": True}  
+    __table_args__ = (
+        # keyset paging of /receiptslist (receiptdate DESC, id DESC)
+        Index("ix_receipts_header_company_date", "companyid", "receiptdate", "id"),
+        {"extend_existing": True},
+    )
     companyid: int = Field(foreign_key="company.id", nullable=False)    
     companyno: str = Field(index=True, nullable=False)
     receiptno: str = Field(index=True, nullable=False)
@@ -39,7 +49,7 @@ class ReceiptsDetail(SQLModel, table=True):
     __tablename__ = "receipts_detail"
     __table_args__ = {"extend_existing": True}  
     id: Optional[int] = Field(default=None, primary_key=True)
-    receiptheaderid: int = Field(foreign_key="receipts_header.id", nullable=False)
+    receiptheaderid: int = Field(foreign_key="receipts_header.id", nullable=False, index=True)
     rowno: Optional[int] = Field(default=1)
     invoiceno: int = Field(foreign_key="invoice_header.id", index=True, nullable=False)
     invoicedate: date = Field(nullable=False)
@@ -182,8 +192,9 @@ class ReceiptsHeaderCreate(BaseModel):
     }
 
 class ReceiptsHeaderResponse(BaseModel):  
-    total: int
+    total: Optional[int] = None
     receipts_list: List[ReceiptsHeaderRead] = []
+    next_cursor: Optional[str] = None
     model_config = {
         "from_attributes": True,
         "json_encoders": {
@@ -247,6 +258,8 @@ class ReceiptsSearch(BaseModel):
     invoiceno: Optional[str] = None
     invoicedate: date
     invoiceamount: float 
+    companyname: Optional[str] = None
+    currencycode: Optional[str] = None
     gcurrency: int
     gexrate: float
     greceiptamount: float
@@ -262,72 +275,57 @@ class ReceiptsSearch(BaseModel):
         }
     }
 
-def get_financial_year(invoice_date: date) -> str:
-    year = invoice_date.year
-    if invoice_date.month < 4:  # Jan, Feb, Mar → previous FY
-        start_year = year - 1
-        end_year = year
-    else:
-        start_year = year
-        end_year = year + 1
-    return f"{start_year}-{str(end_year)[2:]}"
-
-def update_invoice_receipt_amount(session: Session, invoice_id: int, commit=True):
-    total_receipt = session.scalar(
-    select(func.coalesce(func.sum(ReceiptsDetail.greceiptamount), 0))
-    .join(ReceiptsHeader, ReceiptsHeader.id == ReceiptsDetail.receiptheaderid)
-    .where(
-        (ReceiptsDetail.invoiceno == invoice_id)
-        & (ReceiptsHeader.cancel != 'T')
-        )
+def refresh_invoice_receipt_amounts(
+    session: Session, invoice_ids: Optional[List[int]] = None, companyid: Optional[int] = None
+) -> int:
+    """Recompute receiptamount of the given invoices (or a whole company) in one statement.
+
+    UPDATE invoice_header ... FROM (aggregate over receipts_detail). The aggregate
+    starts from the invoices themselves so ones whose receipts were all removed
+    or cancelled drop back to 0; rows whose amount is already right are not touched.
+    """
+    if not invoice_ids and companyid is None:
+        return 0
+    inv = aliased(InvoiceHeader)
+    live = case((ReceiptsHeader.cancel != 'T', ReceiptsDetail.greceiptamount), else_=0)
+    received = (
+        select(inv.id.label("invoiceid"), func.coalesce(func.sum(live), 0).label("amount"))
+        .select_from(inv)
+        .join(ReceiptsDetail, ReceiptsDetail.invoiceno == inv.id, isouter=True)
+        .join(ReceiptsHeader, ReceiptsHeader.id == ReceiptsDetail.receiptheaderid, isouter=True)
+        .group_by(inv.id)
     )
+    if invoice_ids:
+        received = received.where(inv.id.in_(invoice_ids))
+    if companyid is not None:
+        received = received.where(inv.companyid == companyid)
+    received = received.subquery()
 
-    session.execute(
+    companies = session.execute(
         update(InvoiceHeader)
-        .where(InvoiceHeader.id == invoice_id)
-        .values(receiptamount=total_receipt)
-    )
-
-    if commit:
-        session.commit()
+        .where(
+            InvoiceHeader.id == received.c.invoiceid,
+            InvoiceHeader.receiptamount.is_distinct_from(received.c.amount),
+        )
+        .values(receiptamount=received.c.amount)
+        .returning(InvoiceHeader.companyid)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    bump_ledger_version(session, companies)
+    return len(companies)
 
 @router.post("/addreceipts", response_model = ReceiptsHeaderCreate)
 def add_receipts(payload: ReceiptsHeaderCreate, session: Session = Depends(get_session),
-                  current_user: dict = Depends(get_current_user)
+                  current_user: dict = Depends(get_current_user),
+                  idempotency_key: Optional[str] = Header(default=None)
                   ):
+    # ✅ Step 0: A retried request replays the stored response
+    replay = claim_idempotency_key(session, idempotency_key, "/addreceipts", payload)
+    if replay is not None:
+        return replay
     try:
-        # ✅ Step 1: Determine Financial Year using Receipt date
-        def get_financial_year(receiptdate: date):
-            year = receiptdate.year
-            if receiptdate.month < 4:  # Jan–Mar → previous FY
-                start_year = year - 1
-                end_year = year
-            else:
-                start_year = year
-                end_year = year + 1
-            return f"{start_year}-{str(end_year)[2:]}"  # e.g. 2025-26
-
-        finyr = get_financial_year(payload.receiptdate)
-
-        # ✅ Step 2: Get last invoice for same company & FY
-        last_receipt = session.exec(
-            select(ReceiptsHeader)
-            .where(
-                ReceiptsHeader.companyid == payload.companyid,
-                ReceiptsHeader.receiptno.like(f"REC/{finyr}-%")
-            )
-            .order_by(ReceiptsHeader.id.desc())
-            .limit(1)
-        ).first()
-
-        # ✅ Step 3: Determine new Receipt number
-        if last_receipt and last_receipt.receiptno:
-            last_part = int(last_receipt.receiptno.split("-")[-1])
-            new_no = last_part + 1
-        else:
-            new_no = 1
-
-        receiptno = f"REC/{finyr}-{new_no:04d}"
+        # ✅ Step 1: Allocate receipt number from the company/FY counter
+        receiptno = next_document_no(session, payload.companyid, "REC", payload.receiptdate)
 
         db_receipt = ReceiptsHeader.from_orm(payload)
         db_receipt.receiptno = receiptno    
@@ -338,18 +336,18 @@ def add_receipts(payload: ReceiptsHeaderCreate, session: Session = Depends(get_s
             db_detail = ReceiptsDetail(**detail.model_dump(exclude_unset=True))
             db_detail.receiptheaderid = db_receipt.id  
             session.add(db_detail)  
-        session.commit()
-        session.refresh(db_receipt)
-
-        # --- Update invoice receipt amounts ---
+        session.flush()
 
-        unique_invoices = {d.invoiceno for d in payload.receipt_details or []}
-
-        for invoiceno in unique_invoices:
-            update_invoice_receipt_amount(session, invoiceno, commit=False)
-
-            session.commit()
+        # ✅ Step 2: Invoice receipt amounts, same transaction
+        refresh_invoice_receipt_amounts(session, list({d.invoiceno for d in payload.receipt_details}))
+        sync_customer_ledger(session, "REC", [db_receipt.id])
 
+        save_idempotent_response(
+            session, idempotency_key, "/addreceipts",
+            ReceiptsHeaderCreate.model_validate(db_receipt).model_dump(mode="json"),
+        )
+        session.commit()
+        session.refresh(db_receipt)
         return db_receipt
 
       
@@ -372,6 +370,8 @@ def update_receipts(
     # --- Update header fields (excluding details) ---
     for key, value in payload.model_dump(exclude={"receipt_details"}).items():
         setattr(db_receipt, key, value)
+    # line-only edits leave the header unchanged; bump it for the ETag
+    db_receipt.modifiedon = datetime.now()
     session.add(db_receipt)
     session.flush()  # ensure db_receipt.id exists
 
@@ -380,6 +380,8 @@ def update_receipts(
         select(ReceiptsDetail).where(ReceiptsDetail.receiptheaderid == receipt_id)
     ).all()
     existing_ids = {d.id for d in existing_details}
+    # invoices this receipt paid before the edit also need their amount recomputed
+    affected_invoices = {d.invoiceno for d in existing_details}
 
     # --- Handle details from payload ---
     payload_ids = set()
@@ -411,90 +413,91 @@ def update_receipts(
         session.exec(
             delete(ReceiptsDetail).where(ReceiptsDetail.id.in_(ids_to_delete))
         )
+    session.flush()
+
+    # --- Update invoice receipt amounts (old and new invoices), same transaction ---
+    affected_invoices |= {d.invoiceno for d in payload.receipt_details or []}
+    refresh_invoice_receipt_amounts(session, list(affected_invoices))
+    sync_customer_ledger(session, "REC", [receipt_id])
 
     session.commit()
     session.refresh(db_receipt)
+    return db_receipt
 
-    # --- Update invoice receipt amounts ---
-    unique_invoices = {d.invoiceno for d in payload.receipt_details or []}
-
-    for invoiceno in unique_invoices:
-        update_invoice_receipt_amount(session, invoiceno, commit=False)
-
-        session.commit()
 
-    return db_receipt
+@router.post("/receipts/recompute/{companyid}")
+def recompute_receipt_amounts(companyid: int, session: Session = Depends(get_session)):
+    # Admin repair: receiptamount of every invoice of the company in one pass
+    changed = refresh_invoice_receipt_amounts(session, companyid=companyid)
+    session.commit()
+    return {"detail": f"receiptamount corrected on {changed} invoices"}
 
+RECEIPT_SEARCH_PAGE = 100
+RECEIPT_SEARCH_MAX = 500
 
 @router.get("/receiptssearch/{companyid}", response_model=List[ReceiptsSearch])
 def search_receipts(
     companyid: int,
+    response: Response,
     field: str = Query(...),
     value: str = Query(...),
+    limit: Optional[int] = Query(None, ge=1, le=RECEIPT_SEARCH_MAX),
+    cursor: Optional[str] = None,
     db: Session = Depends(get_session),
 ):
+    rh, rd, inv = ReceiptsHeader, ReceiptsDetail, InvoiceHeader
 
+    # One query: receipt lines with their invoice, company, customer and currency
     query = (
-        select(ReceiptsHeader, ReceiptsDetail, InvoiceHeader)
-        .join(
-            ReceiptsDetail,
-            ReceiptsHeader.id == ReceiptsDetail.receiptheaderid
-        )
-        .outerjoin(
-            InvoiceHeader,
-            ReceiptsDetail.invoiceno == InvoiceHeader.id
+        select(
+            rh.id, rh.companyid, rh.companyno, rh.receiptno, rh.receiptdate, rh.receipttype,
+            rh.customerid, rh.receiptamount, rh.paymentmode, rh.currencyid, rh.exrate,
+            rh.transactionno, rh.transactiondate, rh.chequeno, rh.cheqedate, rh.remarks,
+            rh.totalreceiptamount,
+            inv.invoiceno, inv.invoicedate, inv.totnetamount.label("invoiceamount"),
+            rd.id.label("detailid"), rd.gcurrency, rd.gexrate, rd.greceiptamount,
+            rd.commisionamount, rd.tdsamount, rd.netreceiptamount,
+            Company.companyname, CustomerHeader.customername, Currency.currencycode,
         )
-        .where(ReceiptsHeader.companyid == companyid)
+        .select_from(rh)
+        .join(rd, rh.id == rd.receiptheaderid)
+        .outerjoin(inv, rd.invoiceno == inv.id)
+        .outerjoin(Company, Company.id == rh.companyid)
+        .outerjoin(CustomerHeader, CustomerHeader.id == rh.customerid)
+        .outerjoin(Currency, Currency.id == rh.currencyid)
+        .where(rh.companyid == companyid)
     )
 
     if field and value:
         if field == "receiptno":
-            query = query.where(ReceiptsHeader.receiptno.ilike(f"%{value}%"))
+            query = query.where(rh.receiptno.ilike(f"%{value}%"))
         elif field == "customername":
-            query = query.join(CustomerHeader, ReceiptsHeader.customerid == CustomerHeader.id).where(
-                CustomerHeader.customername.ilike(f"%{value}%")
-            )
+            query = query.where(CustomerHeader.customername.ilike(f"%{value}%"))
         elif field == "invoiceno":
-            query = query.where(InvoiceHeader.invoiceno.ilike(f"%{value}%"))
+            query = query.where(inv.invoiceno.ilike(f"%{value}%"))
         else:
             raise HTTPException(status_code=400, detail="Invalid search field")
 
-    results = db.execute(query).all()  # ✅ should use execute() not exec()
-    response = []
-
-    for rechdr, recdtl, invhdr in results:
-        company = db.get(Company, rechdr.companyid)
-        customer = db.get(CustomerHeader, rechdr.customerid)
-        currency = db.get(Currency, rechdr.currencyid)
-
-        # Convert header and detail to dict safely
-        hdr_dict = rechdr.model_dump() if hasattr(rechdr, "model_dump") else rechdr.__dict__.copy()
-        dtl_dict = recdtl.model_dump() if recdtl and hasattr(recdtl, "model_dump") else (recdtl.__dict__.copy() if recdtl else {})
-        inv_dict = invhdr.model_dump() if invhdr and hasattr(invhdr, "model_dump") else (invhdr.__dict__.copy() if invhdr else {})
-
-    # Merge all fields
-        record = {
-            **hdr_dict,
-            **{
-                "invoiceno": inv_dict.get("invoiceno"),
-                "invoicedate": inv_dict.get("invoicedate"),
-                "invoiceamount": inv_dict.get("totnetamount"),
-            },
-            **{
-                "gcurrency": dtl_dict.get("gcurrency"),
-                "gexrate": dtl_dict.get("gexrate"),
-                "greceiptamount": dtl_dict.get("greceiptamount"),
-                "commisionamount": dtl_dict.get("commisionamount"),
-                "tdsamount": dtl_dict.get("tdsamount"),
-                "netreceiptamount": dtl_dict.get("netreceiptamount"),
-            },
-            "companyname": company.companyname if company else None,
-            "customername": customer.customername if customer else None,
-        }
+    # Newest first, stable within a receipt. Paged only when limit or cursor is
+    # given (without them every match is returned, as before); the next page's
+    # cursor is sent back in X-Next-Cursor
+    query = query.order_by(rh.receiptdate.desc(), rh.id.desc(), rd.id.desc())
+    if limit is None and cursor is None:
+        return [ReceiptsSearch(**row._mapping) for row in db.execute(query).all()]
+    limit = limit or RECEIPT_SEARCH_PAGE
+    if cursor:
+        last_date, last_id, last_detail = decode_cursor(cursor, date, int, int)
+        query = query.where(
+            tuple_(rh.receiptdate, rh.id, rd.id) < tuple_(last_date, last_id, last_detail)
+        )
+    rows = db.execute(query.limit(limit + 1)).all()
 
-        response.append(ReceiptsSearch(**record))
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.receiptdate, last.id, last.detailid)
 
-    return response
+    return [ReceiptsSearch(**row._mapping) for row in rows]
 
 
 
@@ -503,52 +506,88 @@ def get_receipts_by_company(
     companyid: int,
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,
+    withtotal: bool = True,
     session: Session = Depends(get_session),
     current_user: dict = Depends(get_current_user),
 ):
-    # 1️⃣ Get total count first (without pagination)
-    total_count = (
-        session.query(ReceiptsHeader)
-        .filter(ReceiptsHeader.companyid == companyid)
-        .count()
+    rh = ReceiptsHeader
+
+    # 1️⃣ One joined query for the page (names resolved in SQL, not per row)
+    statement = (
+        select(rh, Company.companyname, CustomerHeader.customername, Currency.currencycode)
+        .outerjoin(Company, Company.id == rh.companyid)
+        .outerjoin(CustomerHeader, CustomerHeader.id == rh.customerid)
+        .outerjoin(Currency, Currency.id == rh.currencyid)
+        .where(rh.companyid == companyid)
+        .order_by(rh.receiptdate.desc(), rh.id.desc())
     )
+    if cursor:
+        last_date, last_id = decode_cursor(cursor, date, int)
+        statement = statement.where(tuple_(rh.receiptdate, rh.id) < tuple_(last_date, last_id))
+    else:
+        statement = statement.offset(skip)
+    rows = session.exec(statement.limit(limit + 1)).all()
 
-    # 2️⃣ Get paginated receipts
-    db_receipts = (
-        session.query(ReceiptsHeader)
-        .filter(ReceiptsHeader.companyid == companyid)
-        .offset(skip)
-        .limit(limit)
-        .all()
-    )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        next_cursor = encode_cursor(last.receiptdate, last.id)
 
-    if not db_receipts:
+    if not rows:
         #raise HTTPException(status_code=404, detail="No receipts found for this company")
-        return ReceiptsHeaderResponse(total=0,receipts_list=[])
+        return ReceiptsHeaderResponse(total=0 if withtotal else None, receipts_list=[])
 
-    # 3️⃣ Build response list
+    # 2️⃣ Build response list
     receipt_list = []
-    for db_receipt in db_receipts:
-        company = session.get(Company, db_receipt.companyid)
-        customer = session.get(CustomerHeader, db_receipt.customerid)
-        currency = session.get(Currency, db_receipt.currencyid)
-
+    for db_receipt, companyname, customername, currencycode in rows:
         receipt_read = ReceiptsHeaderRead.from_orm(db_receipt)
-        receipt_read.companyname = company.companyname if company else None
-        receipt_read.customername = customer.customername if customer else None
-        receipt_read.currencycode = currency.currencycode if currency else None
-
+        receipt_read.companyname = companyname
+        receipt_read.customername = customername
+        receipt_read.currencycode = currencycode
         receipt_list.append(receipt_read)
 
+    # 3️⃣ Total count (optional, it is the expensive part on large companies)
+    total_count = None
+    if withtotal:
+        total_count = session.exec(
+            select(func.count(rh.id)).where(rh.companyid == companyid)
+        ).first() or 0
+
     # 4️⃣ Return combined response
-    return {"total": total_count, "receipts_list": receipt_list}
+    return {"total": total_count, "receipts_list": receipt_list, "next_cursor": next_cursor}
+
+def receipt_etag(session: Session, receipt_id: int) -> Optional[str]:
+    h, d = ReceiptsHeader, ReceiptsDetail
+    row = session.exec(
+        select(h.modifiedon, func.count(d.id), func.max(d.id), func.sum(d.greceiptamount))
+        .select_from(h)
+        .join(d, d.receiptheaderid == h.id, isouter=True)
+        .where(h.id == receipt_id)
+        .group_by(h.id)
+    ).first()
+    if row is None:
+        return None
+    modifiedon, lines, lastline, amount = row
+    return make_etag("rec", receipt_id, modifiedon.isoformat(), lines, lastline, amount)
 
 @router.get("/receiptdetails/{receipt_id}", response_model=ReceiptDetailResponse)
 def get_receipt_details(
     receipt_id: int,
+    response: Response,
     session: Session = Depends(get_session),
+    if_none_match: Optional[str] = Header(default=None),
     #current_user: dict = Depends(get_current_user),
 ):
+    # Cheap validator first; unchanged receipts are answered with 304
+    etag = receipt_etag(session, receipt_id)
+    if etag is None:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    set_etag(response, etag)
+
     db_receipt = session.get(ReceiptsHeader, receipt_id)
     if not db_receipt:
         raise HTTPException(status_code=404, detail="Receipt not found")
@@ -573,6 +612,11 @@ def delete_receipt(
     if not db_receipt:
         raise HTTPException(status_code=404, detail="Receipt not found")
 
+    # Invoices this receipt paid get their receipt amount back
+    affected_invoices = session.exec(
+        select(ReceiptsDetail.invoiceno).where(ReceiptsDetail.receiptheaderid == receipt_id)
+    ).all()
+
     # Delete associated details first
     session.exec(
         delete(ReceiptsDetail).where(ReceiptsDetail.receiptheaderid == receipt_id)
@@ -580,6 +624,11 @@ def delete_receipt(
 
     # Then delete the receipt header
     session.delete(db_receipt)
+    session.flush()
+
+    # Dependent amounts and the customer ledger, same transaction
+    refresh_invoice_receipt_amounts(session, list(set(affected_invoices)))
+    sync_customer_ledger(session, "REC", [receipt_id])
     session.commit()
 
     return {"detail": "Receipt deleted successfully"}   
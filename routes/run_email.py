@@ -1,31 +1,26 @@
-import requests
+import asyncio
+import logging
+import os
+import sys
 
-BASE_URL = "http://127.0.0.1:8000"
-APPPASSWORD = "ijqitpzaddfpfzev"
+# Standalone email outbox worker (see routes/emailoutbox.py).
+#   python routes/run_email.py            send everything due, then exit
+#   python routes/run_email.py --forever  keep polling the outbox
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-try:
-    # 1️⃣ Test your SMTP settings first
-    tst_url = f"{BASE_URL}/test-smtp"
-    print("Testing SMTP configuration...")
-    r1 = requests.post(tst_url, json={
-        "smtp_host": "smtp.gmail.com",
-        "smtp_port": "587",
-        "email_from": "kumaraveltg@gmail.com",  # Added
-        "email_username": "kumaraveltg@gmail.com",  # Fixed field name
-        "email_password": APPPASSWORD,
-        "use_tls": True
-    })
-    print("SMTP Test Result:", r1.json())
+from routes.emailoutbox import EmailOutboxWorker, outbox_counts
 
-    # Only proceed if test passes
-    if r1.json().get("ok"):
-        # 2️⃣ Then send pending emails
-        send_url = f"{BASE_URL}/sendpending"
-        print("\nSending pending emails...")
-        r2 = requests.post(send_url)
-        print("Send Email Result:", r2.json())
-    else:
-        print("\n SMTP test failed. Fix configuration before sending emails.")
 
-except Exception as e:
-    print("Error:", e)
\ No newline at end of file
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    worker = EmailOutboxWorker()
+    try:
+        asyncio.run(worker.run(once="--forever" not in sys.argv))
+    except KeyboardInterrupt:
+        pass
+    print("Worker:", worker.stats)
+    print("Outbox:", outbox_counts())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import os
+import smtplib
+import time
+from contextlib import contextmanager
+from email.message import EmailMessage
+from threading import Lock
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+
+# Pooled SMTP sessions
+#
+# Opening a connection, STARTTLS and LOGIN per message is what made the outbox
+# slow (and what mail providers throttle as a login storm). Each SMTP config gets
+# a small pool of authenticated sessions; a session sends many messages before it
+# is recycled, idle sessions are checked with NOOP, and a dropped session is
+# replaced and the message retried once. A failed connect or login is remembered
+# for SMTP_FAILURE_HOLD_SECONDS: the rest of the batch fails with the same error
+# without reaching the server.
+
+SMTP_POOL_SIZE = int(os.getenv("PROBILL_SMTP_POOL_SIZE", "4"))
+# Providers cap messages per session (Gmail ~100); reconnect before hitting it
+SMTP_MAX_PER_CONNECTION = int(os.getenv("PROBILL_SMTP_MAX_PER_CONNECTION", "100"))
+SMTP_IDLE_CHECK_SECONDS = 30
+SMTP_TIMEOUT = 30
+# After a failed connect or login, fail fast instead of logging in again per message
+SMTP_FAILURE_HOLD_SECONDS = float(os.getenv("PROBILL_SMTP_FAILURE_HOLD_SECONDS", "60"))
+
+# Errors after which the session is unusable but the message may still go through
+_RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+# Errors that reject one message while the session stays usable
+_MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+
+class SmtpSettings(NamedTuple):
+    host: str
+    port: int
+    use_tls: bool
+    username: str
+    password: Optional[str]
+
+
+class _PooledConnection:
+    def __init__(self, settings: SmtpSettings):
+        self.settings = settings
+        self.smtp: Optional[smtplib.SMTP] = None
+        self.connect()
+
+    def connect(self):
+        s = self.settings
+        smtp = smtplib.SMTP(s.host, s.port, timeout=SMTP_TIMEOUT)
+        try:
+            smtp.ehlo()
+            if s.use_tls:
+                smtp.starttls()
+                smtp.ehlo()
+            if s.password:
+                smtp.login(s.username, s.password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def reconnect(self):
+        self.close()
+        self.connect()
+
+    def alive(self) -> bool:
+        if time.monotonic() - self.last_used < SMTP_IDLE_CHECK_SECONDS:
+            return True
+        try:
+            return self.smtp.noop()[0] == 250
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            self.smtp.close()
+
+    def send(self, msg: EmailMessage):
+        """Send one message; a dropped session is reopened and the message retried once."""
+        if self.sent >= SMTP_MAX_PER_CONNECTION:
+            self.reconnect()
+        try:
+            self.smtp.send_message(msg)
+        except _RECONNECT_ERRORS:
+            self.reconnect()
+            self.smtp.send_message(msg)
+        except _MESSAGE_ERRORS:
+            # the message is bad; reset the transaction (or the session, if it closed)
+            try:
+                self.smtp.rset()
+            except Exception:
+                self.reconnect()
+            raise
+        self.sent += 1
+        self.last_used = time.monotonic()
+
+
+class SmtpPool:
+    def __init__(self, settings: SmtpSettings, size: int = SMTP_POOL_SIZE):
+        self.settings = settings
+        self.size = size
+        self._idle: List[_PooledConnection] = []
+        self._lock = Lock()
+        self._failed: Optional[Tuple[float, Exception]] = None  # (when, error) of the last failed connect
+
+    @contextmanager
+    def connection(self) -> Iterator[_PooledConnection]:
+        conn = None
+        with self._lock:
+            while self._idle and conn is None:
+                candidate = self._idle.pop()
+                if candidate.alive():
+                    conn = candidate
+                else:
+                    candidate.close()
+        if conn is None:
+            conn = self._connect()
+        try:
+            yield conn
+        except _MESSAGE_ERRORS:
+            # a rejected message leaves the session usable
+            self._release(conn)
+            raise
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn)
+
+    def _connect(self) -> _PooledConnection:
+        with self._lock:
+            failed = self._failed
+        if failed and time.monotonic() - failed[0] < SMTP_FAILURE_HOLD_SECONDS:
+            raise failed[1]
+        try:
+            conn = _PooledConnection(self.settings)
+        except Exception as e:
+            with self._lock:
+                self._failed = (time.monotonic(), e)
+            raise
+        with self._lock:
+            self._failed = None
+        return conn
+
+    def _release(self, conn: _PooledConnection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def send(self, msg: EmailMessage):
+        """Send one message over a pooled session (safe to call from many threads)."""
+        with self.connection() as conn:
+            conn.send(msg)
+
+
+_pools: Dict[SmtpSettings, SmtpPool] = {}
+_pools_lock = Lock()
+
+
+def get_smtp_pool(settings: SmtpSettings) -> SmtpPool:
+    with _pools_lock:
+        pool = _pools.get(settings)
+        if pool is None:
+            pool = _pools[settings] = SmtpPool(settings)
+        return pool